@@ -23,8 +23,14 @@ that occur - hook commands are only automatically invoked when one or more
 metadata sources have changed things.
 
 The last version of a file is available under $FILENAME.last.
+
+A digest of the canonical json of the current and last versions is kept
+alongside them in $FILENAME.sha256 and $FILENAME.last.sha256 so that changes
+can be detected without parsing them, and so that unchanged files are not
+rewritten.
 """
 
+import hashlib
 import json
 import os
 import shutil
@@ -37,6 +43,51 @@ def get_path(name):
     return os.path.join(cfg.CONF.cachedir, '%s.json' % name)
 
 
+def digest(content):
+    '''Return a stable digest of the canonical json form of content.'''
+    canonical = json.dumps(content, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _digest_path(path):
+    return '%s.sha256' % path
+
+
+def _read_digest(path, parse=True):
+    '''Return the digest of the json file at path, or None if missing.'''
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(_digest_path(path)) as f:
+            return f.read().strip()
+    except OSError:
+        if not parse:
+            return None
+        # Written before digests were kept, so fall back to parsing it
+        with open(path) as f:
+            return digest(json.load(f))
+
+
+def _write_digest(path, value):
+    with tempfile.NamedTemporaryFile(prefix='tmp_digest.',
+                                     dir=os.path.dirname(path),
+                                     delete=False) as out:
+        out.write(value.encode('utf-8'))
+    os.rename(out.name, _digest_path(path))
+
+
+def _remove_digest(path):
+    # Done before replacing the file so that an interruption can never leave
+    # a digest which does not match the file.
+    if os.path.exists(_digest_path(path)):
+        os.unlink(_digest_path(path))
+
+
+def get_file_digest(path):
+    '''Return the digest of the cache file at path, or None if missing.'''
+    return _read_digest(path)
+
+
 def store(name, content):
     if not os.path.exists(cfg.CONF.cachedir):
         os.mkdir(cfg.CONF.cachedir)
@@ -45,32 +96,100 @@ def store(name, content):
     dest_path = get_path(name)
     orig_path = '%s.orig' % dest_path
     last_path = '%s.last' % dest_path
-
-    with tempfile.NamedTemporaryFile(
-            dir=cfg.CONF.cachedir,
-            delete=False) as new:
-        new.write(json.dumps(content, indent=1).encode('utf-8'))
-        new.flush()
-        if not os.path.exists(orig_path):
-            shutil.copy(new.name, orig_path)
-            changed = True
-        os.rename(new.name, dest_path)
+    content_digest = digest(content)
+
+    # Identical content leaves the existing file and its mtime untouched
+    if (_read_digest(dest_path, parse=False) != content_digest
+            or not os.path.exists(orig_path)):
+        _remove_digest(dest_path)
+        with tempfile.NamedTemporaryFile(
+                dir=cfg.CONF.cachedir,
+                delete=False) as new:
+            new.write(json.dumps(content, indent=1).encode('utf-8'))
+            new.flush()
+            if not os.path.exists(orig_path):
+                shutil.copy(new.name, orig_path)
+                changed = True
+            os.rename(new.name, dest_path)
+        _write_digest(dest_path, content_digest)
 
     if not changed:
-        if os.path.exists(last_path):
-            with open(last_path) as then:
-                then_value = json.load(then)
-                if then_value != content:
-                    changed = True
-        else:
-            changed = True
+        changed = _read_digest(last_path) != content_digest
     return (changed, dest_path)
 
 
 def commit(name):
     dest_path = get_path(name)
     if os.path.exists(dest_path):
-        shutil.copy(dest_path, '%s.last' % dest_path)
+        last_path = '%s.last' % dest_path
+        _remove_digest(last_path)
+        # Replaced rather than rewritten in place, as the old file may be
+        # hard linked into the backup cache dir
+        with tempfile.NamedTemporaryFile(prefix='tmp_last.',
+                                         dir=os.path.dirname(last_path),
+                                         delete=False) as out:
+            pass
+        shutil.copy(dest_path, out.name)
+        os.rename(out.name, last_path)
+        _write_digest(last_path, _read_digest(dest_path))
+
+
+def _same_file(src_st, dest_st):
+    if (src_st.st_dev, src_st.st_ino) == (dest_st.st_dev, dest_st.st_ino):
+        return True
+    return (src_st.st_size == dest_st.st_size
+            and src_st.st_mtime_ns == dest_st.st_mtime_ns)
+
+
+def _mirror_file(src, dest):
+    tmp = os.path.join(os.path.dirname(dest),
+                       '.tmp_mirror.%s' % os.path.basename(dest))
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        # Different filesystem, or links not supported
+        shutil.copy2(src, tmp)
+    os.rename(tmp, dest)
+
+
+def mirror(src_dir, dest_dir):
+    '''Bring dest_dir up to date with the contents of src_dir.
+
+    Only files which differ are copied, using hard links where the
+    filesystem allows it. Each file is replaced atomically, so dest_dir and
+    the files in it never disappear while they are being updated.
+    '''
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+        shutil.copystat(src_dir, dest_dir)
+    wanted = set()
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            wanted.add(entry.name)
+            dest = os.path.join(dest_dir, entry.name)
+            if entry.is_dir():
+                if os.path.lexists(dest) and not os.path.isdir(dest):
+                    os.unlink(dest)
+                mirror(entry.path, dest)
+                continue
+            if os.path.isdir(dest) and not os.path.islink(dest):
+                shutil.rmtree(dest)
+            try:
+                dest_st = os.stat(dest)
+            except OSError:
+                dest_st = None
+            if dest_st is None or not _same_file(entry.stat(), dest_st):
+                _mirror_file(entry.path, dest)
+    with os.scandir(dest_dir) as entries:
+        for entry in entries:
+            if entry.name in wanted:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
 
 
 def store_meta_list(name, data_keys):
@@ -13,11 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent import futures
+import io
 import json
 import os
 
-from keystoneclient.contrib.ec2 import utils as ec2_utils
-from lxml import etree
 from oslo_config import cfg
 from oslo_log import log
 import urllib.parse as urlparse
@@ -52,16 +52,76 @@ opts = [
                          '"deployment-key"'),
     cfg.FloatOpt('timeout', default=10,
                  help='Seconds to wait for the connection and read request'
-                      ' timeout.')
+                      ' timeout.'),
+    cfg.IntOpt('workers', default=4, min=1,
+               help='Number of resources to describe concurrently.'),
 ]
 name = 'cfn'
 
 
+def watched_paths():
+    '''Paths whose changes may change what this collector returns.'''
+    hint = CONF.cfn.heat_metadata_hint
+    if not hint:
+        return []
+    return [(os.path.dirname(hint), os.path.basename(hint))]
+
+
 class Collector:
 
-    def __init__(self, requests_impl=common.requests):
-        self._requests_impl = requests_impl
-        self._session = requests_impl.Session()
+    def __init__(self, requests_impl=None):
+        self._requests_impl = requests_impl or common.requests
+        self._session = self._requests_impl.Session()
+
+    def _extract(self, content, fields):
+        '''Return the text of the given StackResourceDetail fields.
+
+        The response is parsed incrementally, straight from bytes, and only
+        the requested fields are kept. Missing fields are left out.
+        '''
+        from lxml import etree
+        values = {}
+        try:
+            for event, element in etree.iterparse(
+                    io.BytesIO(content), events=('end',), tag=fields):
+                parent = element.getparent()
+                if (parent is not None and
+                        parent.tag == 'StackResourceDetail' and
+                        parent.getparent() is not None and
+                        parent.getparent().tag ==
+                        'DescribeStackResourceResult'):
+                    values[element.tag] = element.text
+                    if len(values) == len(fields):
+                        break
+                element.clear()
+        except etree.XMLSyntaxError as e:
+            logger.warning('Invalid DescribeStackResource response (%s)' % e)
+            raise exc.CfnMetadataNotAvailable
+        return values
+
+    def _describe(self, signer, url, stack_name, resource, fields, headers):
+        '''Return the requested StackResourceDetail fields of a resource.'''
+        params = {'Action': 'DescribeStackResource',
+                  'StackName': stack_name,
+                  'LogicalResourceId': resource,
+                  'AWSAccessKeyId': CONF.cfn.access_key_id,
+                  'SignatureVersion': '2'}
+        parsed_url = urlparse.urlparse(url)
+        credentials = {'params': params,
+                       'verb': 'GET',
+                       'host': parsed_url.netloc,
+                       'path': parsed_url.path}
+        params['Signature'] = signer.generate(credentials)
+        try:
+            content = self._session.get(
+                url, params=params, headers=headers,
+                verify=CONF.cfn.ca_certificate,
+                timeout=CONF.cfn.timeout)
+            content.raise_for_status()
+        except self._requests_impl.exceptions.RequestException as e:
+            logger.warning(e)
+            raise exc.CfnMetadataNotAvailable
+        return self._extract(content.content, fields)
 
     def collect(self):
         if CONF.cfn.metadata_url is None:
@@ -86,7 +146,9 @@ class Collector:
             logger.info('No path configured')
             raise exc.CfnMetadataNotConfigured
 
+        from keystoneclient.contrib.ec2 import utils as ec2_utils
         signer = ec2_utils.Ec2Signer(secret_key=CONF.cfn.secret_access_key)
+        paths = []
         for path in CONF.cfn.path:
             if '.' not in path:
                 logger.error('Path not in format resource.field[.x.y] (%s)' %
@@ -97,35 +159,27 @@ class Collector:
                 field, sub_path = field.split('.', 1)
             else:
                 sub_path = ''
-            params = {'Action': 'DescribeStackResource',
-                      'StackName': stack_name,
-                      'LogicalResourceId': resource,
-                      'AWSAccessKeyId': CONF.cfn.access_key_id,
-                      'SignatureVersion': '2'}
-            parsed_url = urlparse.urlparse(url)
-            credentials = {'params': params,
-                           'verb': 'GET',
-                           'host': parsed_url.netloc,
-                           'path': parsed_url.path}
-            params['Signature'] = signer.generate(credentials)
-            try:
-                content = self._session.get(
-                    url, params=params, headers=headers,
-                    verify=CONF.cfn.ca_certificate,
-                    timeout=CONF.cfn.timeout)
-                content.raise_for_status()
-            except self._requests_impl.exceptions.RequestException as e:
-                logger.warning(e)
-                raise exc.CfnMetadataNotAvailable
-            map_content = etree.fromstring(content.text)
-            resource_detail = map_content.find(
-                'DescribeStackResourceResult').find('StackResourceDetail')
-            sub_element = resource_detail.find(field)
-            if sub_element is None:
-                logger.warnng('Path %s does not exist.' % (path))
+            paths.append((path, resource, field, sub_path))
+
+        # Each resource is described once, however many paths refer to it
+        resources = {}
+        for path, resource, field, sub_path in paths:
+            resources.setdefault(resource, set()).add(field)
+        workers = max(min(CONF.cfn.workers, len(resources)), 1)
+        with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            details = dict(zip(resources, pool.map(
+                lambda resource: self._describe(
+                    signer, url, stack_name, resource,
+                    sorted(resources[resource]), headers),
+                resources)))
+
+        for path, resource, field, sub_path in paths:
+            text = details[resource].get(field)
+            if text is None:
+                logger.warning('Path %s does not exist.' % (path))
                 raise exc.CfnMetadataNotAvailable
             try:
-                value = json.loads(sub_element.text)
+                value = json.loads(text)
             except ValueError as e:
                 logger.warning(
                     'Path {} failed to parse as json. ({})'.format(path, e))
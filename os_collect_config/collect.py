@@ -13,30 +13,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections.abc
+from concurrent import futures
 import hashlib
+import importlib.metadata
 import json
 import os
 import random
+import select
 import shutil
 import signal
 import subprocess
 import sys
+import threading
 import time
 
 from oslo_config import cfg
 from oslo_log import log
 
 from os_collect_config import cache
-from os_collect_config import cfn
-from os_collect_config import ec2
 from os_collect_config import exc
-from os_collect_config import heat
-from os_collect_config import heat_local
+from os_collect_config import inotify
 from os_collect_config import keystone
-from os_collect_config import local
-from os_collect_config import request
+from os_collect_config import metrics
+from os_collect_config import schedule
 from os_collect_config import version
-from os_collect_config import zaqar
 
 DEFAULT_COLLECTORS = ['heat_local', 'ec2', 'cfn', 'heat', 'request', 'local',
                       'zaqar']
@@ -101,18 +102,102 @@ opts = [
                       '(on different hosts) do not attempt to poll at the '
                       'exact same time if they were all started at the same '
                       'time. Ignored if --one-time or --force is used.'),
+    cfg.BoolOpt('parallel',
+                default=False,
+                help='Run all of the collectors concurrently instead of one '
+                     'after the other. The results are still stored and '
+                     'emitted in the order given by the collectors option.'),
+    cfg.FloatOpt('collect-timeout',
+                 default=0,
+                 help='When collecting in parallel, skip any collector which '
+                      'has not returned within this many seconds for the '
+                      'current cycle. Disabled when set to 0.'),
+    cfg.BoolOpt('watch',
+                default=False,
+                help='When running continuously, also wake up as soon as '
+                     'the files read by local collectors such as local and '
+                     'heat_local change instead of waiting for the next '
+                     'poll. Requires inotify.'),
+    cfg.BoolOpt('export-changed-files',
+                default=False,
+                help='Also pass the command OS_CONFIG_CHANGED_FILES, listing '
+                     'the files which changed since the command last '
+                     'succeeded, and OS_CONFIG_FILE_DIGESTS, listing the '
+                     'sha256 digest of the canonical json content (sorted '
+                     'keys, no whitespace) of each file in OS_CONFIG_FILES, '
+                     'so that it can skip unchanged configuration.'),
+    cfg.FloatOpt('coalesce-window',
+                 default=0,
+                 min=0,
+                 help='When running continuously, hold back the command '
+                      'after a change and keep collecting every '
+                      'min-polling-interval seconds for as long as further '
+                      'changes arrive, up to this many seconds, then run '
+                      'the command once for all of them. Disabled when set '
+                      'to 0.'),
 ]
 
 CONF = cfg.CONF
 logger = log.getLogger('os-collect-config')
 
-COLLECTORS = {ec2.name: ec2,
-              cfn.name: cfn,
-              heat.name: heat,
-              heat_local.name: heat_local,
-              local.name: local,
-              request.name: request,
-              zaqar.name: zaqar}
+
+BUILTIN_COLLECTORS = ('ec2', 'cfn', 'heat', 'heat_local', 'local', 'request',
+                      'zaqar')
+
+COLLECTOR_NAMESPACE = 'os_collect_config.collectors'
+
+
+def _entry_points(group):
+    eps = importlib.metadata.entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=group)
+    # Python < 3.10
+    return eps.get(group, ())
+
+
+class CollectorRegistry(collections.abc.Mapping):
+    """Maps collector names to their modules.
+
+    Besides the built in collectors, other packages can provide collectors
+    through the os_collect_config.collectors entry point group, naming a
+    module with a Collector class and optionally opts, watched_paths and
+    pushes. Entry points are only scanned when a name other than a built in
+    collector is needed, and a collector module, along with the client
+    libraries it needs, is only imported when it is looked up.
+    """
+
+    def __init__(self, builtins, namespace=COLLECTOR_NAMESPACE):
+        self._builtins = {
+            name: importlib.metadata.EntryPoint(name, module, namespace)
+            for name, module in builtins}
+        self._namespace = namespace
+        self._entry_points = None
+
+    def _all(self):
+        if self._entry_points is None:
+            entry_points = {ep.name: ep
+                            for ep in _entry_points(self._namespace)}
+            # A plugin can not replace a built in collector
+            entry_points.update(self._builtins)
+            self._entry_points = entry_points
+        return self._entry_points
+
+    def __getitem__(self, name):
+        entry_point = self._builtins.get(name) or self._all()[name]
+        return entry_point.load()
+
+    def __contains__(self, name):
+        return name in self._builtins or name in self._all()
+
+    def __iter__(self):
+        return iter(self._all())
+
+    def __len__(self):
+        return len(self._all())
+
+
+COLLECTORS = CollectorRegistry(
+    (name, 'os_collect_config.%s' % name) for name in BUILTIN_COLLECTORS)
 
 
 def setup_conf():
@@ -148,20 +233,150 @@ def setup_conf():
     CONF.register_group(request_group)
     CONF.register_group(keystone_group)
     CONF.register_group(zaqar_group)
-    CONF.register_cli_opts(ec2.opts, group='ec2')
-    CONF.register_cli_opts(cfn.opts, group='cfn')
-    CONF.register_cli_opts(heat_local.opts, group='heat_local')
-    CONF.register_cli_opts(local.opts, group='local')
-    CONF.register_cli_opts(heat.opts, group='heat')
-    CONF.register_cli_opts(request.opts, group='request')
+    for collector in ('ec2', 'cfn', 'heat_local', 'local', 'heat',
+                      'request'):
+        CONF.register_cli_opts(COLLECTORS[collector].opts, group=collector)
     CONF.register_cli_opts(keystone.opts, group='keystone')
-    CONF.register_cli_opts(zaqar.opts, group='zaqar')
+    CONF.register_cli_opts(COLLECTORS['zaqar'].opts, group='zaqar')
+    for collector in BUILTIN_COLLECTORS:
+        CONF.register_cli_opts(schedule.opts, group=collector)
 
     CONF.register_cli_opts(opts)
+    CONF.register_cli_opts(metrics.opts)
     log.register_options(CONF)
 
 
-def collect_all(collectors, store=False, collector_kwargs_map=None):
+def setup_plugin_conf(collectors):
+    """Register the options of the enabled plugin collectors.
+
+    This happens once the command line has been parsed, so that only the
+    plugins in use are imported. Their options can therefore only be set
+    in the config file.
+    """
+    for collector in collectors:
+        if collector in BUILTIN_COLLECTORS:
+            continue
+        CONF.register_group(cfg.OptGroup(name=collector))
+        CONF.register_opts(getattr(COLLECTORS[collector], 'opts', []),
+                           group=collector)
+        CONF.register_opts(schedule.opts, group=collector)
+
+
+# Collector instances are kept for the lifetime of the process so that
+# connection pools and per-collector state survive between polling cycles.
+_collectors = {}
+
+
+def get_collector(collector, collector_kwargs=None):
+    """Return the long-lived instance of a collector.
+
+    A new instance is only built the first time a collector is requested or
+    when it is requested with different constructor arguments.
+    """
+    collector_kwargs = dict(collector_kwargs or {})
+    cached = _collectors.get(collector)
+    if cached is None or cached[0] != collector_kwargs:
+        if cached is not None:
+            _close_collector(cached[1])
+        instance = COLLECTORS[collector].Collector(**collector_kwargs)
+        cached = (collector_kwargs, instance)
+        _collectors[collector] = cached
+    return cached[1]
+
+
+def _close_collector(instance):
+    close = getattr(instance, 'close', None)
+    if close:
+        close()
+
+
+def reset_collectors():
+    """Drop all long-lived collector instances and their last results."""
+    for (collector_kwargs, instance) in _collectors.values():
+        _close_collector(instance)
+    _collectors.clear()
+    _last_results.clear()
+
+
+def _collect_one(collector, collector_kwargs_map=None):
+    if collector_kwargs_map and collector in collector_kwargs_map:
+        collector_kwargs = collector_kwargs_map[collector]
+    else:
+        collector_kwargs = {}
+
+    start = time.monotonic()
+    try:
+        return get_collector(collector, collector_kwargs).collect()
+    except exc.SourceNotAvailable:
+        logger.warning('Source [%s] Unavailable.' % collector)
+    except exc.SourceNotConfigured:
+        logger.debug('Source [%s] Not configured.' % collector)
+    finally:
+        metrics.collected(collector, time.monotonic() - start)
+
+
+# Collectors still running after missing a previous cycle's deadline, so
+# that a hung source is never run twice at the same time.
+_in_flight = {}
+
+
+def _start_collect(collector, collector_kwargs_map=None):
+    """Run a collector on a daemon thread and return a Future of its result.
+
+    Unlike the workers of a ThreadPoolExecutor, daemon threads are not
+    joined when the interpreter exits, so a collector abandoned after
+    collect-timeout can not keep a one-time run alive.
+    """
+    future = futures.Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(_collect_one(collector, collector_kwargs_map))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name='collect-%s' % collector,
+                     daemon=True).start()
+    return future
+
+
+def _collect_parallel(collectors, collector_kwargs_map=None):
+    pending = {}
+    for collector in collectors:
+        previous = _in_flight.get(collector)
+        if previous is not None and not previous.done():
+            logger.warning('Source [%s] still running from a previous '
+                           'cycle, skipping.' % collector)
+            continue
+        pending[collector] = _start_collect(collector, collector_kwargs_map)
+    (done, not_done) = futures.wait(
+        pending.values(), timeout=CONF.collect_timeout or None)
+
+    results = []
+    for collector in collectors:
+        future = pending.get(collector)
+        if future is None:
+            results.append(None)
+        elif future in not_done:
+            logger.warning('Source [%s] timed out after %.2f seconds.' %
+                           (collector, CONF.collect_timeout))
+            _in_flight[collector] = future
+            results.append(None)
+        else:
+            _in_flight.pop(collector, None)
+            results.append(future.result())
+    return results
+
+
+# The most recent result of each collector, reused for collectors which
+# are not due to be polled in a cycle.
+_last_results = {}
+
+
+def collect_all(collectors, store=False, collector_kwargs_map=None,
+                due=None):
     changed_keys = set()
     all_keys = list()
     if store:
@@ -169,54 +384,124 @@ def collect_all(collectors, store=False, collector_kwargs_map=None):
     else:
         paths_or_content = {}
 
-    for collector in collectors:
-        module = COLLECTORS[collector]
-        if collector_kwargs_map and collector in collector_kwargs_map:
-            collector_kwargs = collector_kwargs_map[collector]
+    if due is None:
+        due = collectors
+    polled = [collector for collector in collectors if collector in due]
+    with metrics.phase('collect'):
+        if CONF.parallel:
+            results = _collect_parallel(polled, collector_kwargs_map)
         else:
-            collector_kwargs = {}
-
-        try:
-            content = module.Collector(**collector_kwargs).collect()
-        except exc.SourceNotAvailable:
-            logger.warning('Source [%s] Unavailable.' % collector)
-            continue
-        except exc.SourceNotConfigured:
-            logger.debug('Source [%s] Not configured.' % collector)
-            continue
+            results = [_collect_one(collector, collector_kwargs_map)
+                       for collector in polled]
+    _last_results.update(zip(polled, results))
+
+    with metrics.phase('store'):
+        for collector in collectors:
+            content = _last_results.get(collector)
+            if content is None:
+                continue
+
+            if store:
+                for output_key, output_content in content:
+                    all_keys.append(output_key)
+                    (changed, path) = cache.store(output_key,
+                                                  output_content)
+                    if changed:
+                        changed_keys.add(output_key)
+                    paths_or_content.append(path)
+                    metrics.stored(collector, path, changed)
+            else:
+                paths_or_content.update(content)
 
-        if store:
-            for output_key, output_content in content:
-                all_keys.append(output_key)
-                (changed, path) = cache.store(output_key, output_content)
-                if changed:
-                    changed_keys.add(output_key)
-                paths_or_content.append(path)
-        else:
-            paths_or_content.update(content)
+        if changed_keys:
+            cache.store_meta_list('os_config_files', all_keys)
 
     if changed_keys:
-        cache.store_meta_list('os_config_files', all_keys)
-        if os.path.exists(CONF.backup_cachedir):
-            shutil.rmtree(CONF.backup_cachedir)
-        if os.path.exists(CONF.cachedir):
-            shutil.copytree(CONF.cachedir, CONF.backup_cachedir)
+        with metrics.phase('mirror'):
+            if os.path.exists(CONF.cachedir):
+                cache.mirror(CONF.cachedir, CONF.backup_cachedir)
+            elif os.path.exists(CONF.backup_cachedir):
+                shutil.rmtree(CONF.backup_cachedir)
     return (changed_keys, paths_or_content)
 
 
+def watched_paths(collectors):
+    """Return the local paths the given collectors read from."""
+    paths = []
+    for collector in collectors:
+        module_paths = getattr(COLLECTORS[collector], 'watched_paths', None)
+        if module_paths:
+            paths.extend(module_paths())
+    return paths
+
+
+def push_collectors(collectors):
+    """Return the collectors which have updates pushed to them."""
+    return [c for c in collectors
+            if getattr(COLLECTORS[c], 'pushes', lambda: False)()]
+
+
 def reexec_self(signal=None, frame=None):
     if signal:
         logger.info('Signal received. Re-executing %s' % sys.argv)
+    reset_collectors()
     # Close all but stdin/stdout/stderr
     os.closerange(3, 255)
     os.execv(sys.argv[0], sys.argv)
 
 
-def call_command(files, command):
+class ChangeCoalescer:
+    """Hold back the command while a burst of changes is arriving.
+
+    After the first change, the command is held back for as long as each
+    collection brings further changes, up to window seconds in total.
+    """
+    def __init__(self, window):
+        self.window = window
+        self._deadline = None
+        self._digests = None
+
+    def hold(self, files):
+        """Return True to collect again before running the command."""
+        if not self.window:
+            return False
+        digests = [(f, cache.get_file_digest(f)) for f in files]
+        now = time.monotonic()
+        if self._deadline is None:
+            self._deadline = now + self.window
+        elif digests == self._digests or now >= self._deadline:
+            self.reset()
+            return False
+        self._digests = digests
+        return True
+
+    def holding(self):
+        return self._deadline is not None
+
+    def remaining(self):
+        return max(self._deadline - time.monotonic(), 0)
+
+    def reset(self):
+        self._deadline = None
+        self._digests = None
+
+
+def call_command(files, command, changed_keys=None):
     env = dict(os.environ)
     env["OS_CONFIG_FILES"] = ':'.join(files)
     logger.info("Executing %s with OS_CONFIG_FILES=%s" %
                 (command, env["OS_CONFIG_FILES"]))
+    if CONF.export_changed_files:
+        if changed_keys is None:
+            changed_files = files
+        else:
+            changed_paths = set(cache.get_path(k) for k in changed_keys)
+            changed_files = [f for f in files if f in changed_paths]
+        env["OS_CONFIG_CHANGED_FILES"] = ':'.join(changed_files)
+        env["OS_CONFIG_FILE_DIGESTS"] = ':'.join(
+            cache.get_file_digest(f) for f in files)
+        logger.info("OS_CONFIG_CHANGED_FILES=%s" %
+                    env["OS_CONFIG_CHANGED_FILES"])
     subprocess.check_call(CONF.command, env=env, shell=True)
 
 
@@ -239,6 +524,44 @@ def getfilehash(files):
     return m.hexdigest()
 
 
+def getfilestats(files):
+    """Returns what stat reports about the identity of a list of files.
+
+    :param files: a list of files to stat
+    :returns: list -- (st_ino, st_size, st_mtime_ns) for each file, or None
+              for files which do not exist
+    """
+    stats = []
+    for filename in files:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            stats.append(None)
+        else:
+            stats.append((st.st_ino, st.st_size, st.st_mtime_ns))
+    return stats
+
+
+class FileChangeDetector:
+    """Detects changes to the contents of a list of files.
+
+    The files are only read and hashed again when stat reports a different
+    inode, size or modification time for one of them.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self._stats = getfilestats(files)
+        self._hash = getfilehash(files)
+
+    def changed(self):
+        stats = getfilestats(self.files)
+        if stats == self._stats:
+            return False
+        self._stats = stats
+        return getfilehash(self.files) != self._hash
+
+
 def main(args=sys.argv, collector_kwargs_map=None):
     signal.signal(signal.SIGHUP, reexec_self)
     # NOTE(bnemec): We need to exit on SIGPIPEs so systemd can restart us.
@@ -258,11 +581,12 @@ def main(args=sys.argv, collector_kwargs_map=None):
         print(CONF.cachedir)
         return
 
-    unknown_collectors = set(CONF.collectors) - set(COLLECTORS.keys())
+    unknown_collectors = [c for c in CONF.collectors if c not in COLLECTORS]
     if unknown_collectors:
         raise exc.InvalidArguments(
             'Unknown collectors %s. Valid collectors are: %s' %
-            (list(unknown_collectors), DEFAULT_COLLECTORS))
+            (unknown_collectors, sorted(COLLECTORS)))
+    setup_plugin_conf(CONF.collectors)
 
     if CONF.force:
         CONF.set_override('one_time', True)
@@ -273,45 +597,92 @@ def main(args=sys.argv, collector_kwargs_map=None):
         time.sleep(random.randrange(0, CONF.splay))
 
     exitval = 0
-    config_files = CONF.config_file
-    config_hash = getfilehash(config_files)
-    exponential_sleep_time = CONF.min_polling_interval
+    config_files = FileChangeDetector(CONF.config_file)
+    # shorter sleeps at first allow for faster software deployment
+    # dependency processing
+    scheduler = schedule.Scheduler(CONF.collectors)
+    store_and_run = bool(CONF.command and not CONF.print_only)
+    watcher = None
+    notify_fds = []
+    if store_and_run and not CONF.one_time:
+        if CONF.watch:
+            paths = watched_paths(CONF.collectors)
+            if paths:
+                watcher = inotify.watcher(paths)
+        if push_collectors(CONF.collectors):
+            notify_fds.append(schedule.notify_fd())
+    coalescer = ChangeCoalescer(0 if CONF.one_time else CONF.coalesce_window)
+    record_metrics = store_and_run and metrics.enabled()
     while True:
-        # shorter sleeps while changes are detected allows for faster
-        # software deployment dependency processing
-        store_and_run = bool(CONF.command and not CONF.print_only)
+        if record_metrics:
+            metrics.start_cycle()
+        due = scheduler.due()
         (changed_keys, content) = collect_all(
             cfg.CONF.collectors,
             store=store_and_run,
-            collector_kwargs_map=collector_kwargs_map)
+            collector_kwargs_map=collector_kwargs_map,
+            due=due)
+        scheduler.polled(due)
         if store_and_run:
-            if changed_keys or CONF.force:
+            if changed_keys and not CONF.force and coalescer.hold(content):
+                logger.info('Changes detected, collecting again before '
+                            'running command.')
+            elif changed_keys or CONF.force:
+                coalescer.reset()
                 # ignore HUP now since we will reexec after commit anyway
                 signal.signal(signal.SIGHUP, signal.SIG_IGN)
                 try:
-                    call_command(content, CONF.command)
+                    with metrics.phase('command'):
+                        # A forced run re-applies everything
+                        call_command(content, CONF.command,
+                                     None if CONF.force else changed_keys)
                 except subprocess.CalledProcessError as e:
                     exitval = e.returncode
                     logger.error('Command failed, will not cache new data. %s'
                                  % e)
                 else:
-                    for changed in changed_keys:
-                        cache.commit(changed)
+                    with metrics.phase('commit'):
+                        for changed in changed_keys:
+                            cache.commit(changed)
                 if not CONF.one_time:
-                    new_config_hash = getfilehash(config_files)
-                    if config_hash != new_config_hash:
+                    with metrics.phase('config_check'):
+                        config_changed = config_files.changed()
+                    if config_changed:
+                        metrics.finish_cycle()
                         reexec_self()
             else:
+                coalescer.reset()
                 logger.debug("No changes detected.")
+            metrics.finish_cycle()
             if CONF.one_time:
                 break
             else:
-                logger.info("Sleeping %.2f seconds.", exponential_sleep_time)
-                time.sleep(exponential_sleep_time)
-
-            exponential_sleep_time *= 2
-            if exponential_sleep_time > CONF.polling_interval:
-                exponential_sleep_time = CONF.polling_interval
+                sleep_time = scheduler.next_sleep()
+                if coalescer.holding():
+                    sleep_time = min(CONF.min_polling_interval,
+                                     coalescer.remaining())
+                    scheduler.wake(CONF.collectors)
+                logger.info("Sleeping %.2f seconds.", sleep_time)
+                if watcher is None and not notify_fds:
+                    time.sleep(sleep_time)
+                    scheduler.slept(sleep_time)
+                else:
+                    start = time.monotonic()
+                    if watcher is None:
+                        select.select(notify_fds, [], [], sleep_time)
+                        woken = False
+                    else:
+                        woken = watcher.wait(sleep_time, notify_fds)
+                    scheduler.slept(time.monotonic() - start)
+                    if woken:
+                        logger.info('Local metadata changed.')
+                        scheduler.wake(
+                            [c for c in CONF.collectors
+                             if watched_paths([c])])
+                pushed = schedule.notified()
+                if pushed:
+                    logger.info('Updates pushed to %s.' % ', '.join(pushed))
+                    scheduler.wake(pushed)
         else:
             print(json.dumps(content, indent=1))
             break
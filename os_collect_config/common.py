@@ -1,3 +1,6 @@
-import requests
-
-__all__ = ['requests']
+def __getattr__(name):
+    # requests is only imported by the collectors which use it
+    if name == 'requests':
+        import requests
+        return requests
+    raise AttributeError(name)
@@ -24,6 +24,11 @@ logger = log.getLogger('os-collect-config')
 
 
 PROC_MOUNTS_PATH = '/proc/mounts'
+SYS_BLOCK_PATH = '/sys/class/block'
+SYS_DEV_BLOCK_PATH = '/sys/dev/block'
+DEV_DISK_PATH = '/dev/disk'
+UDEV_DATA_PATH = '/run/udev/data'
+CONFIG_DRIVE_LABEL = 'config-2'
 
 
 class BlockDevice:
@@ -34,6 +39,8 @@ class BlockDevice:
 
     label = None
 
+    uuid = None
+
     mountpoint = None
 
     unmount = False
@@ -41,7 +48,14 @@ class BlockDevice:
     ATTR_MAP = {
         'DEVNAME': 'devname',
         'TYPE': 'type',
-        'LABEL': 'label'
+        'LABEL': 'label',
+        'UUID': 'uuid'
+    }
+
+    UDEV_ATTR_MAP = {
+        'ID_FS_TYPE': 'type',
+        'ID_FS_LABEL': 'label',
+        'ID_FS_UUID': 'uuid'
     }
 
     @staticmethod
@@ -66,6 +80,19 @@ class BlockDevice:
                 setattr(bd, cls.ATTR_MAP[var], value)
         return bd
 
+    @classmethod
+    def from_udev_data(cls, devname, data_str):
+        '''Construct BlockDevice from its udev database entry.'''
+        bd = cls()
+        bd.devname = devname
+        for line in data_str.splitlines():
+            if not line.startswith('E:'):
+                continue
+            var, value = cls.parse_shell_var(line[2:])
+            if var in cls.UDEV_ATTR_MAP:
+                setattr(bd, cls.UDEV_ATTR_MAP[var], value)
+        return bd
+
     def config_drive_candidate(self):
         '''Whether this block device is a v2 config-drive.'''
         return self.label == 'config-2' and self.type in (
@@ -144,10 +171,9 @@ class BlockDevice:
                                                  self.label)
 
 
-def all_block_devices():
-    '''Run blkid and yield a BlockDevice for all devices.'''
+def _blkid(*devnames):
     try:
-        cmd = ['blkid', '-o', 'export']
+        cmd = ['blkid', '-o', 'export'] + list(devnames)
         out = subprocess.check_output(cmd, universal_newlines=True)
     except Exception as e:
         logger.error('Problem running "%s": %s', ' '.join(cmd), e)
@@ -157,6 +183,72 @@ def all_block_devices():
             yield BlockDevice.from_blkid_export(device)
 
 
+def all_block_devices():
+    '''Run blkid and yield a BlockDevice for all devices.'''
+    return _blkid()
+
+
+def _udev_data_path(rdev):
+    return os.path.join(UDEV_DATA_PATH,
+                        'b%d:%d' % (os.major(rdev), os.minor(rdev)))
+
+
+def _probe(devname):
+    '''Return a BlockDevice for one device, from udev if possible.'''
+    try:
+        with open(_udev_data_path(os.stat(devname).st_rdev)) as f:
+            bd = BlockDevice.from_udev_data(devname, f.read())
+        if bd.type:
+            return bd
+    except OSError:
+        pass
+    for bd in _blkid(devname):
+        return bd
+
+
+def _udev_labelled(label):
+    '''Yield a BlockDevice for each device udev knows to carry label.'''
+    try:
+        entries = sorted(os.listdir(UDEV_DATA_PATH))
+    except OSError:
+        return
+    for entry in entries:
+        if not entry.startswith('b'):
+            continue
+        try:
+            with open(os.path.join(UDEV_DATA_PATH, entry)) as f:
+                data = f.read()
+            if 'E:ID_FS_LABEL=%s' % label not in data.splitlines():
+                continue
+            uevent = os.path.join(SYS_DEV_BLOCK_PATH, entry[1:], 'uevent')
+            with open(uevent) as f:
+                for line in f.read().splitlines():
+                    var, value = BlockDevice.parse_shell_var(line)
+                    if var == 'DEVNAME':
+                        yield BlockDevice.from_udev_data(
+                            os.path.join('/dev', value), data)
+        except OSError:
+            continue
+
+
+def candidate_block_devices():
+    '''Yield the block devices which may hold a config drive.
+
+    The /dev/disk/by-label link and the udev database are checked first, so
+    blkid probes at most the one labelled device. Only hosts without udev
+    have every block device probed by blkid.
+    '''
+    link = os.path.join(DEV_DISK_PATH, 'by-label', CONFIG_DRIVE_LABEL)
+    if os.path.exists(link):
+        bd = _probe(os.path.realpath(link))
+        if bd:
+            yield bd
+    elif os.path.isdir(UDEV_DATA_PATH):
+        yield from _udev_labelled(CONFIG_DRIVE_LABEL)
+    else:
+        yield from all_block_devices()
+
+
 def config_drive():
     """Return the first device expected to contain a v2 config drive.
 
@@ -164,14 +256,97 @@ def config_drive():
     * either vfat or iso9660 formated
     * labeled with 'config-2'
     """
-    for bd in all_block_devices():
+    for bd in candidate_block_devices():
         if bd.config_drive_candidate():
             return bd
 
 
-def get_metadata():
-    """Return discovered config drive metadata, or an empty dict."""
+def _device_size(devname):
+    try:
+        rdev = os.stat(devname).st_rdev
+        size_path = os.path.join(
+            SYS_DEV_BLOCK_PATH,
+            '%d:%d' % (os.major(rdev), os.minor(rdev)), 'size')
+        with open(size_path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _block_devices():
+    try:
+        return frozenset(os.listdir(SYS_BLOCK_PATH))
+    except OSError:
+        return None
+
+
+class DiscoveryCache:
+    """Remembers the outcome of config drive discovery.
+
+    A found config drive is remembered by its devname, label, UUID and size,
+    and its metadata is reused while the device still matches. Not finding
+    a config drive is remembered until the set of block devices changes or
+    a device labelled config-2 appears.
+    """
+
+    def __init__(self):
+        self._devices = None
+        self._identity = None
+        self._metadata = None
+
+    def _matches(self):
+        (devname, label, uuid, size) = self._identity
+        if size is None or _device_size(devname) != size:
+            return False
+        # Where udev maintains the links, they must still point at devname
+        for (links, value) in (('by-label', label), ('by-uuid', uuid)):
+            links = os.path.join(DEV_DISK_PATH, links)
+            if value and os.path.isdir(links):
+                if (os.path.realpath(os.path.join(links, value)) !=
+                        os.path.realpath(devname)):
+                    return False
+        return True
+
+    def lookup(self):
+        """Return the remembered metadata, or None if it may be stale."""
+        if self._metadata is None:
+            return None
+        if self._identity is not None:
+            if self._matches():
+                return self._metadata
+        elif (self._devices is not None and
+                self._devices == _block_devices() and
+                not os.path.exists(os.path.join(
+                    DEV_DISK_PATH, 'by-label', CONFIG_DRIVE_LABEL))):
+            return self._metadata
+        self._metadata = None
+        return None
+
+    def store(self, bd, metadata):
+        self._devices = _block_devices()
+        self._identity = None
+        self._metadata = None
+        if bd is None:
+            self._metadata = {}
+        elif metadata:
+            # Failures to read the drive are not remembered
+            self._identity = (bd.devname, bd.label, bd.uuid,
+                              _device_size(bd.devname))
+            self._metadata = metadata
+
+
+def get_metadata(cache=None):
+    """Return discovered config drive metadata, or an empty dict.
+
+    Discovery is skipped while the optional DiscoveryCache is still valid.
+    """
+    if cache is not None:
+        md = cache.lookup()
+        if md is not None:
+            logger.debug('Using cached config drive discovery')
+            return md
     bd = config_drive()
-    if bd:
-        return bd.get_metadata()
-    return {}
+    md = bd.get_metadata() if bd else {}
+    if cache is not None:
+        cache.store(bd, md)
+    return md
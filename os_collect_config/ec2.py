@@ -13,8 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent import futures
 import json
 import os
+import time
 
 from oslo_config import cfg
 from oslo_log import log
@@ -33,36 +35,70 @@ opts = [
                help='URL to query for EC2 Metadata'),
     cfg.FloatOpt('timeout', default=10,
                  help='Seconds to wait for the connection and read request'
-                      ' timeout.')
+                      ' timeout.'),
+    cfg.IntOpt('workers', default=8, min=1,
+               help='Number of metadata requests to make concurrently while'
+                    ' crawling the metadata tree.'),
+    cfg.FloatOpt('crawl-timeout', default=0,
+                 help='Seconds allowed for crawling the whole metadata tree.'
+                      ' Disabled when set to 0.'),
 ]
 name = 'ec2'
 
 
 class Collector:
-    def __init__(self, requests_impl=common.requests):
-        self._requests_impl = requests_impl
-        self.session = requests_impl.Session()
+    def __init__(self, requests_impl=None):
+        self._requests_impl = requests_impl or common.requests
+        self.session = self._requests_impl.Session()
+        self._config_drive_cache = config_drive.DiscoveryCache()
 
-    def _fetch_metadata(self, fetch_url, timeout):
+    def _get(self, fetch_url, timeout, deadline=None):
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log.getLogger(__name__).warn(
+                    'Metadata crawl timed out before fetching %s' % fetch_url)
+                raise exc.Ec2MetadataNotAvailable
+            timeout = min(timeout, remaining)
         try:
             r = self.session.get(fetch_url, timeout=timeout)
             r.raise_for_status()
         except self._requests_impl.exceptions.RequestException as e:
             log.getLogger(__name__).warn(e)
             raise exc.Ec2MetadataNotAvailable
-        content = r.text
-        if fetch_url[-1] == '/':
-            new_content = {}
-            for subkey in content.split("\n"):
-                if '=' in subkey:
-                    subkey = subkey[:subkey.index('=')] + '/'
-                sub_fetch_url = fetch_url + subkey
-                if subkey[-1] == '/':
-                    subkey = subkey[:-1]
-                new_content[subkey] = self._fetch_metadata(
-                    sub_fetch_url, timeout)
-            content = new_content
-        return content
+        return r.text
+
+    def _fetch_metadata(self, fetch_url, timeout, workers=1, crawl_timeout=0):
+        if crawl_timeout:
+            deadline = time.monotonic() + crawl_timeout
+        else:
+            deadline = None
+        content = {}
+        # The tree is crawled one level at a time, fetching every entry of
+        # a level concurrently. Each entry is (url, parent, key in parent).
+        level = [(fetch_url, content, None)]
+        with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            while level:
+                responses = pool.map(
+                    lambda entry: self._get(entry[0], timeout, deadline),
+                    level)
+                next_level = []
+                for (url, parent, key), text in zip(level, responses):
+                    if url[-1] != '/':
+                        parent[key] = text
+                        continue
+                    parent[key] = {}
+                    for subkey in text.split("\n"):
+                        if not subkey:
+                            continue
+                        if '=' in subkey:
+                            subkey = subkey[:subkey.index('=')] + '/'
+                        sub_fetch_url = url + subkey
+                        if subkey[-1] == '/':
+                            subkey = subkey[:-1]
+                        next_level.append((sub_fetch_url, parent[key], subkey))
+                level = next_level
+        return content[None]
 
     def collect(self):
         cache_path = cache.get_path('ec2')
@@ -76,9 +112,11 @@ class Collector:
                 if metadata:
                     return [('ec2', metadata)]
 
-        md = config_drive.get_metadata()
+        md = config_drive.get_metadata(cache=self._config_drive_cache)
         if md:
             return [('ec2', md)]
 
         root_url = '%s/' % (CONF.ec2.metadata_url)
-        return [('ec2', self._fetch_metadata(root_url, CONF.ec2.timeout))]
+        return [('ec2', self._fetch_metadata(root_url, CONF.ec2.timeout,
+                                             CONF.ec2.workers,
+                                             CONF.ec2.crawl_timeout))]
@@ -12,8 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from heatclient import client as heatclient
-from keystoneclient.v3 import client as keystoneclient
 from oslo_config import cfg
 from oslo_log import log
 
@@ -46,12 +44,18 @@ name = 'heat'
 
 class Collector:
     def __init__(self,
-                 keystoneclient=keystoneclient,
-                 heatclient=heatclient,
+                 keystoneclient=None,
+                 heatclient=None,
                  discover_class=None):
+        # The client libraries are only imported once heat is collected from
+        if keystoneclient is None:
+            from keystoneclient.v3 import client as keystoneclient
+        if heatclient is None:
+            from heatclient import client as heatclient
         self.keystoneclient = keystoneclient
         self.heatclient = heatclient
         self.discover_class = discover_class
+        self._endpoint = None
 
     def collect(self):
         if CONF.heat.auth_url is None:
@@ -75,22 +79,25 @@ class Collector:
         # NOTE(flwang): To be compatible with old versions, we won't throw
         # error here if there is no region name.
 
+        keystone_wrapper = None
         try:
-            ks = keystone.Keystone(
+            keystone_wrapper = keystone.get_keystone(
                 auth_url=CONF.heat.auth_url,
                 user_id=CONF.heat.user_id,
                 password=CONF.heat.password,
                 project_id=CONF.heat.project_id,
                 keystoneclient=self.keystoneclient,
-                discover_class=self.discover_class).client
-            kwargs = {'service_type': 'orchestration',
-                      'endpoint_type': 'publicURL'}
-            if CONF.heat.region_name:
-                kwargs['region_name'] = CONF.heat.region_name
-            endpoint = ks.service_catalog.url_for(**kwargs)
-            logger.debug('Fetching metadata from %s' % endpoint)
+                discover_class=self.discover_class)
+            ks = keystone_wrapper.client
+            if self._endpoint is None:
+                kwargs = {'service_type': 'orchestration',
+                          'endpoint_type': 'publicURL'}
+                if CONF.heat.region_name:
+                    kwargs['region_name'] = CONF.heat.region_name
+                self._endpoint = ks.service_catalog.url_for(**kwargs)
+            logger.debug('Fetching metadata from %s' % self._endpoint)
             heat = self.heatclient.Client(
-                '1', endpoint, token=ks.auth_token)
+                '1', self._endpoint, token=ks.auth_token)
             r = heat.resources.metadata(CONF.heat.stack_id,
                                         CONF.heat.resource_name)
 
@@ -100,4 +107,10 @@ class Collector:
 
         except Exception as e:
             logger.warning(str(e))
+            self._endpoint = None
+            from heatclient import exc as heat_exc
+            auth_errors = keystone.auth_errors() + (
+                heat_exc.HTTPUnauthorized,)
+            if keystone_wrapper and isinstance(e, auth_errors):
+                keystone.discard_keystone(keystone_wrapper)
             raise exc.HeatMetadataNotAvailable
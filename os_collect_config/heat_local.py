@@ -33,6 +33,12 @@ name = 'heat_local'
 logger = log.getLogger(__name__)
 
 
+def watched_paths():
+    '''Paths whose changes may change what this collector returns.'''
+    return [(os.path.dirname(path), os.path.basename(path))
+            for path in cfg.CONF.heat_local.path]
+
+
 class Collector:
     def __init__(self, requests_impl=None):
         pass
@@ -0,0 +1,120 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Wait for changes to local metadata paths using Linux inotify."""
+
+import ctypes
+import os
+import select
+import struct
+import time
+
+from oslo_log import log
+
+logger = log.getLogger(__name__)
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT = struct.Struct('iIII')
+
+
+class Watcher:
+    '''Sleep until a timeout expires or one of a set of paths changes.
+
+    Each watched path is a (directory, name) tuple. A name of None matches
+    any entry of the directory, otherwise only that entry is matched.
+    Directories which do not exist yet are watched once they appear.
+    '''
+    def __init__(self, paths):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs = {}
+        for directory, name in paths:
+            names = self._dirs.setdefault(directory, set())
+            if names is not None:
+                self._dirs[directory] = None if name is None else (
+                    names | {name})
+        self._wds = {}
+
+    def _watch(self):
+        for directory, names in self._dirs.items():
+            wd = self._add_watch(self._fd, os.fsencode(directory),
+                                 WATCH_MASK)
+            if wd >= 0:
+                self._wds[wd] = names
+
+    def _read_events(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(
+                    data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    self._wds.pop(wd, None)
+                    changed = True
+                    continue
+                names = self._wds.get(wd)
+                if names is None or name in names:
+                    changed = True
+
+    def wait(self, timeout, fds=()):
+        '''Returns True if woken by a change, False on timeout.
+
+        Also returns False as soon as any of fds is readable.
+        '''
+        self._watch()
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            (readable, _, _) = select.select(
+                [self._fd] + list(fds), [], [], remaining)
+            if self._fd in readable and self._read_events():
+                return True
+            if set(readable) & set(fds):
+                return False
+
+    def close(self):
+        os.close(self._fd)
+
+
+def watcher(paths):
+    '''Return a Watcher for paths, or None if inotify is not available.'''
+    try:
+        return Watcher(paths)
+    except (AttributeError, OSError) as e:
+        logger.warning('Unable to watch local metadata paths (%s)' % e)
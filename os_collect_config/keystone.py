@@ -12,16 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
 import hashlib
 import os
+import threading
 
-from dogpile import cache
-from keystoneclient import discover as ks_discover
-from keystoneclient import exceptions as ks_exc
-from keystoneclient.v3 import client as ks_keystoneclient
 from oslo_config import cfg
+from oslo_log import log
 
 CONF = cfg.CONF
+logger = log.getLogger(__name__)
+
+# NOTE: keystoneclient and dogpile are imported where they are used, so
+# that registering the options below stays cheap.
+
+
+def auth_errors():
+    '''Errors after which cached credentials must not be reused.'''
+    from keystoneclient import exceptions as ks_exc
+    return (ks_exc.AuthorizationFailure, ks_exc.Unauthorized)
+
 
 opts = [
     cfg.StrOpt('cache_dir',
@@ -29,9 +39,54 @@ opts = [
     cfg.IntOpt('cache_ttl',
                default=1800,
                help='Seconds to store auth references in the cache'),
+    cfg.IntOpt('refresh_margin',
+               default=300,
+               min=0,
+               help='Renew auth tokens in the background this many seconds '
+                    'before they expire. Disabled when set to 0.'),
 ]
 
 
+# Never refresh a token in the background sooner than this many seconds
+# after getting it.
+MIN_REFRESH_DELAY = 10
+
+
+# Process-local tier in front of each dbm token cache, keyed by the dbm
+# path, so the file is only read when this process has no usable entry.
+_memory_caches = {}
+
+# Keystone wrappers are kept for the lifetime of the process so that
+# discovery and authentication are not repeated on every poll.
+_keystones = {}
+
+
+def get_keystone(auth_url, user_id, password, project_id,
+                 keystoneclient=None, discover_class=None):
+    '''Return the shared Keystone wrapper for a set of credentials.'''
+    key = (auth_url, user_id, password, project_id, keystoneclient,
+           discover_class)
+    ks = _keystones.get(key)
+    if ks is None:
+        ks = Keystone(auth_url, user_id, password, project_id,
+                      keystoneclient=keystoneclient,
+                      discover_class=discover_class)
+        _keystones[key] = ks
+    return ks
+
+
+def discard_keystone(ks):
+    '''Forget a shared Keystone wrapper after an authentication failure.
+
+    The next get_keystone() for the same credentials repeats discovery, so
+    a keystone endpoint which has moved is picked up without a restart.
+    '''
+    ks.invalidate()
+    for key, value in list(_keystones.items()):
+        if value is ks:
+            del _keystones[key]
+
+
 class Keystone:
     '''A keystone wrapper class.
 
@@ -52,12 +107,19 @@ class Keystone:
         @param object discover_class optional keystoneclient.discover.Discover
                                      class.
         '''
+        from dogpile import cache
+        from keystoneclient import discover as ks_discover
+        from keystoneclient import exceptions as ks_exc
+        from keystoneclient.v3 import client as ks_keystoneclient
+
         self.keystoneclient = keystoneclient or ks_keystoneclient
         self.discover_class = discover_class or ks_discover.Discover
         self.user_id = user_id
         self.password = password
         self.project_id = project_id
         self._client = None
+        self._lock = threading.Lock()
+        self._refresh_timer = None
         try:
             auth_url_noneversion = auth_url.replace('/v2.0', '/')
             discover = self.discover_class(auth_url=auth_url_noneversion)
@@ -77,8 +139,14 @@ class Keystone:
                 'dogpile.cache.dbm',
                 expiration_time=CONF.keystone.cache_ttl,
                 arguments={"filename": dbm_path})
+            self.memory_cache = cache.make_region().configure(
+                'dogpile.cache.memory',
+                expiration_time=CONF.keystone.cache_ttl,
+                arguments={
+                    "cache_dict": _memory_caches.setdefault(dbm_path, {})})
         else:
             self.cache = None
+            self.memory_cache = None
 
     def _make_key(self, key):
         m = hashlib.sha256()
@@ -88,42 +156,113 @@ class Keystone:
         m.update(key.encode('utf-8'))
         return m.hexdigest()
 
+    def _expiring(self):
+        auth_ref = getattr(self._client, 'auth_ref', None)
+        return auth_ref is not None and auth_ref.will_expire_soon()
+
+    def _authenticate(self):
+        return self.keystoneclient.Client(
+            auth_url=self.auth_url,
+            user_id=self.user_id,
+            password=self.password,
+            project_id=self.project_id)
+
+    def _schedule_refresh(self):
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+        auth_ref = getattr(self._client, 'auth_ref', None)
+        expires = getattr(auth_ref, 'expires', None)
+        if not CONF.keystone.refresh_margin or expires is None:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc)
+        lifetime = (expires - now).total_seconds()
+        if lifetime <= CONF.keystone.refresh_margin:
+            # Every new token would be due for a refresh straight away, so
+            # leave renewing it to the next use once it expires soon.
+            logger.debug('Auth token lifetime of %ds is within the refresh '
+                         'margin, not refreshing in the background' %
+                         lifetime)
+            return
+        delay = max(lifetime - CONF.keystone.refresh_margin,
+                    min(MIN_REFRESH_DELAY, lifetime / 2))
+        self._refresh_timer = threading.Timer(delay, self._refresh)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _refresh(self):
+        '''Replace the client with a newly authenticated one.'''
+        logger.debug('Refreshing auth token for %s' % self.auth_url)
+        try:
+            client = self._authenticate()
+        except Exception as e:
+            # The next poll authenticates in the foreground instead
+            logger.warning('Failed to refresh auth token (%s)' % e)
+            return
+        with self._lock:
+            self._client = client
+            self._set_auth_ref_in_cache(client.auth_ref)
+            self._schedule_refresh()
+
     @property
     def client(self):
-        if not self._client:
-            ref = self._get_auth_ref_from_cache()
-            if ref:
-                self._client = self.keystoneclient.Client(
-                    auth_ref=ref)
-            else:
-                self._client = self.keystoneclient.Client(
-                    auth_url=self.auth_url,
-                    user_id=self.user_id,
-                    password=self.password,
-                    project_id=self.project_id)
-        return self._client
+        with self._lock:
+            if self._client and self._expiring():
+                self.invalidate()
+            if not self._client:
+                ref = self._get_auth_ref_from_cache()
+                if ref:
+                    self._client = self.keystoneclient.Client(
+                        auth_ref=ref)
+                else:
+                    self._client = self._authenticate()
+                self._schedule_refresh()
+            return self._client
 
     def _get_auth_ref_from_cache(self):
         if self.cache:
             key = self._make_key('auth_ref')
-            return self.cache.get(key)
+            ref = self.memory_cache.get(key)
+            if not ref:
+                cached = self.cache.get_value_metadata(key)
+                if cached is not None:
+                    ref = cached.payload
+                    # Keep the time it was cached at, so the ref expires
+                    # from both tiers together
+                    self.memory_cache.backend.set(key, cached)
+            return ref
+
+    def _set_auth_ref_in_cache(self, ref):
+        if self.cache:
+            key = self._make_key('auth_ref')
+            self.memory_cache.set(key, ref)
+            self.cache.set(key, ref)
 
     @property
     def auth_ref(self):
         ref = self._get_auth_ref_from_cache()
         if not ref:
             ref = self.client.get_auth_ref()
-            if self.cache:
-                self.cache.set(self._make_key('auth_ref'), ref)
+            self._set_auth_ref_in_cache(ref)
         return ref
 
     def invalidate_auth_ref(self):
         if self.cache:
             key = self._make_key('auth_ref')
+            self.memory_cache.delete(key)
             return self.cache.delete(key)
 
+    def invalidate(self):
+        '''Forget the client and auth ref so the next use authenticates.'''
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+        self._client = None
+        self.invalidate_auth_ref()
+
     @property
     def service_catalog(self):
+        from keystoneclient import exceptions as ks_exc
         try:
             return self.client.service_catalog
         except ks_exc.AuthorizationFailure:
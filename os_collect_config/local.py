@@ -51,14 +51,37 @@ def _dest_looks_insecure(local_path):
     return looks_insecure
 
 
+def watched_paths():
+    '''Paths whose changes may change what this collector returns.'''
+    return [(local_path, None) for local_path in cfg.CONF.local.path]
+
+
 class Collector:
     def __init__(self, requests_impl=None):
-        pass
+        # Parsed files by path, with the (st_ino, st_size, st_mtime_ns) they
+        # were parsed at
+        self._parsed = {}
+
+    def _load(self, data_file, st):
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        parsed = self._parsed.get(data_file)
+        if parsed and parsed[0] == key:
+            return parsed[1]
+        with open(data_file) as metadata:
+            try:
+                value = json.loads(metadata.read())
+            except ValueError as e:
+                logger.error(
+                    '{} is not valid JSON ({})'.format(data_file, e))
+                raise exc.LocalMetadataNotAvailable
+        self._parsed[data_file] = (key, value)
+        return value
 
     def collect(self):
         if len(cfg.CONF.local.path) == 0:
             raise exc.LocalMetadataNotAvailable
         final_content = []
+        seen = set()
         for local_path in cfg.CONF.local.path:
             try:
                 os.stat(local_path)
@@ -67,27 +90,24 @@ class Collector:
                 continue
             if _dest_looks_insecure(local_path):
                 raise exc.LocalMetadataNotAvailable
-            for data_file in os.listdir(local_path):
-                if data_file.startswith('.'):
-                    continue
-                data_file = os.path.join(local_path, data_file)
-                if os.path.isdir(data_file):
-                    continue
-                st = os.stat(data_file)
-                if st.st_mode & stat.S_IWOTH:
-                    logger.error(
-                        '%s is world writable. This is a security risk.' %
-                        data_file)
-                    raise exc.LocalMetadataNotAvailable
-                with open(data_file) as metadata:
-                    try:
-                        value = json.loads(metadata.read())
-                    except ValueError as e:
+            with os.scandir(local_path) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        continue
+                    st = entry.stat()
+                    if st.st_mode & stat.S_IWOTH:
                         logger.error(
-                            '{} is not valid JSON ({})'.format(data_file, e))
+                            '%s is world writable. This is a security risk.'
+                            % entry.path)
                         raise exc.LocalMetadataNotAvailable
-                    basename = os.path.basename(data_file)
-                    final_content.append((basename, value))
+                    seen.add(entry.path)
+                    final_content.append(
+                        (entry.name, self._load(entry.path, st)))
+        # Forget files which have gone away
+        for data_file in set(self._parsed) - seen:
+            del self._parsed[data_file]
         if not final_content:
             logger.info('No local metadata found (%s)' %
                         cfg.CONF.local.path)
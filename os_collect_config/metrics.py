@@ -0,0 +1,214 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Timing metrics of each collection cycle.
+
+main() starts a cycle before collecting and finishes it before sleeping.
+In between, the wall time of each phase, and the time, size and changed
+keys of each collector are recorded. Finishing a cycle writes them to a
+json stats file in the cachedir and to a Prometheus textfile collector
+file, as configured.
+
+Recording is a no-op while no cycle is started, so the collection
+functions can be used without metrics.
+"""
+
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log
+
+logger = log.getLogger(__name__)
+
+CONF = cfg.CONF
+
+STATS_NAME = 'os_collect_config_stats'
+
+opts = [
+    cfg.BoolOpt('write-stats',
+                default=False,
+                help='Write the timings of each collection cycle to '
+                     '%s.json in the cachedir.' % STATS_NAME),
+    cfg.StrOpt('prometheus-textfile',
+               help='Write the timings of each collection cycle to this '
+                    'file in the Prometheus text format, for the '
+                    'node_exporter textfile collector. The file name must '
+                    'end in .prom.'),
+]
+
+
+class Cycle:
+    '''The metrics of a single collection cycle.'''
+
+    def __init__(self, number):
+        self.number = number
+        self.started = time.monotonic()
+        self.seconds = None
+        self.phases = {}
+        self.collectors = {}
+        self.keys = 0
+        self.keys_changed = 0
+        self.cache_hits = 0
+        self._lock = threading.Lock()
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def collector(self, collector):
+        with self._lock:
+            return self.collectors.setdefault(
+                collector, {'seconds': 0, 'bytes': 0, 'keys': 0,
+                            'keys_changed': 0})
+
+    def as_dict(self):
+        return {
+            'cycle': self.number,
+            'timestamp': time.time(),
+            'seconds': self.seconds,
+            'phases': self.phases,
+            'collectors': self.collectors,
+            'keys': self.keys,
+            'keys_changed': self.keys_changed,
+            'cache_hits': self.cache_hits,
+        }
+
+
+_cycle = None
+_cycles = 0
+
+
+def enabled():
+    return bool(CONF.write_stats or CONF.prometheus_textfile)
+
+
+def start_cycle():
+    global _cycle, _cycles
+    _cycles += 1
+    _cycle = Cycle(_cycles)
+    return _cycle
+
+
+@contextlib.contextmanager
+def phase(name):
+    '''Add the wall time of the block to the named phase.'''
+    cycle = _cycle
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if cycle is not None:
+            cycle.add_phase(name, time.monotonic() - start)
+
+
+def collected(collector, seconds):
+    if _cycle is not None:
+        _cycle.collector(collector)['seconds'] = seconds
+
+
+def stored(collector, path, changed):
+    '''Record a key stored in the cache at path.'''
+    if _cycle is None:
+        return
+    stats = _cycle.collector(collector)
+    stats['keys'] += 1
+    _cycle.keys += 1
+    try:
+        stats['bytes'] += os.path.getsize(path)
+    except OSError:
+        pass
+    if changed:
+        stats['keys_changed'] += 1
+        _cycle.keys_changed += 1
+    else:
+        _cycle.cache_hits += 1
+
+
+def _write(path, data):
+    with tempfile.NamedTemporaryFile('w', prefix='tmp_metrics.',
+                                     dir=os.path.dirname(path) or '.',
+                                     delete=False) as out:
+        out.write(data)
+    os.chmod(out.name, 0o644)
+    os.rename(out.name, path)
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus_text(cycle):
+    '''Return cycle in the Prometheus text exposition format.'''
+    lines = []
+
+    def metric(name, help_text, samples, kind='gauge'):
+        name = 'os_collect_config_%s' % name
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in samples:
+            if labels:
+                labels = '{%s}' % ','.join(
+                    '%s="%s"' % (k, _label(v)) for k, v in labels)
+            else:
+                labels = ''
+            lines.append('%s%s %r' % (name, labels, value))
+
+    metric('cycles_total', 'Collection cycles run.', [((), cycle.number)],
+           kind='counter')
+    metric('last_cycle_timestamp_seconds',
+           'Time the last collection cycle finished.',
+           [((), time.time())])
+    metric('cycle_seconds', 'Wall time of the last collection cycle.',
+           [((), cycle.seconds)])
+    metric('phase_seconds',
+           'Wall time of each phase of the last collection cycle.',
+           [((('phase', p),), s) for p, s in sorted(cycle.phases.items())])
+    collectors = sorted(cycle.collectors.items())
+    for stat, help_text in (
+            ('seconds', 'Wall time of each collector in the last cycle.'),
+            ('bytes', 'Size of the metadata stored by each collector.'),
+            ('keys', 'Keys stored by each collector.'),
+            ('keys_changed', 'Changed keys stored by each collector.')):
+        metric('collector_%s' % stat, help_text,
+               [((('collector', c),), s[stat]) for c, s in collectors])
+    metric('keys_changed', 'Keys changed in the last collection cycle.',
+           [((), cycle.keys_changed)])
+    metric('cache_hits',
+           'Keys which matched the cache in the last collection cycle.',
+           [((), cycle.cache_hits)])
+    return '\n'.join(lines) + '\n'
+
+
+def finish_cycle():
+    '''Stop recording the current cycle and write out its metrics.'''
+    global _cycle
+    cycle = _cycle
+    _cycle = None
+    if cycle is None:
+        return
+    cycle.seconds = time.monotonic() - cycle.started
+    try:
+        if CONF.write_stats and os.path.exists(CONF.cachedir):
+            _write(os.path.join(CONF.cachedir, '%s.json' % STATS_NAME),
+                   json.dumps(cycle.as_dict(), indent=1))
+        if CONF.prometheus_textfile:
+            _write(CONF.prometheus_textfile, prometheus_text(cycle))
+    except OSError as e:
+        logger.warning('Unable to write metrics (%s)' % e)
+    return cycle
@@ -15,11 +15,14 @@
 
 import calendar
 import json
+import os
+import tempfile
 import time
 
 from oslo_config import cfg
 from oslo_log import log
 
+from os_collect_config import cache
 from os_collect_config import common
 from os_collect_config import exc
 from os_collect_config import merger
@@ -38,10 +41,12 @@ name = 'request'
 
 
 class Collector:
-    def __init__(self, requests_impl=common.requests):
-        self._requests_impl = requests_impl
-        self._session = requests_impl.Session()
+    def __init__(self, requests_impl=None):
+        self._requests_impl = requests_impl or common.requests
+        self._session = self._requests_impl.Session()
         self.last_modified = None
+        self.last_list = None
+        self.validators = None
 
     def check_fetch_content(self, headers):
         '''Raises RequestMetadataNotAvailable if metadata should not be
@@ -68,6 +73,39 @@ class Collector:
             raise exc.RequestMetadataNotAvailable
         return last_modified
 
+    def _validators_path(self):
+        return '%s.validators' % cache.get_path(name)
+
+    def _load_previous(self):
+        '''Load the validators and metadata saved by an earlier process.'''
+        try:
+            with open(self._validators_path()) as f:
+                validators = json.load(f)
+            with open(cache.get_path(name)) as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return
+        # Only trust the cached copy if it is what the validators describe
+        if (validators.get('url') != CONF.request.metadata_url
+                or validators.get('digest') != cache.digest(value)):
+            return
+        self.validators = validators
+        self.last_list = merger.merged_list_from_content(
+            value, cfg.CONF.deployment_key, name)
+
+    def _save_validators(self):
+        if not os.path.isdir(cfg.CONF.cachedir):
+            return
+        try:
+            with tempfile.NamedTemporaryFile(
+                    prefix='tmp_validators.',
+                    dir=cfg.CONF.cachedir,
+                    delete=False) as out:
+                out.write(json.dumps(self.validators).encode('utf-8'))
+            os.rename(out.name, self._validators_path())
+        except OSError as e:
+            logger.warning('Failed to save validators (%s)' % e)
+
     def collect(self):
         if CONF.request.metadata_url is None:
             logger.info('No metadata_url configured.')
@@ -76,12 +114,31 @@ class Collector:
         timeout = CONF.request.timeout
         final_content = {}
 
-        try:
-            head = self._session.head(url, timeout=timeout)
-            last_modified = self.check_fetch_content(head.headers)
+        if self.last_list is None:
+            self._load_previous()
+        headers = {}
+        if self.last_list is not None and self.validators:
+            if self.validators.get('etag'):
+                headers['If-None-Match'] = self.validators['etag']
+            if self.validators.get('last-modified'):
+                headers['If-Modified-Since'] = (
+                    self.validators['last-modified'])
 
-            content = self._session.get(url, timeout=timeout)
+        try:
+            content = self._session.get(url, headers=headers,
+                                        timeout=timeout)
+            if content.status_code == 304:
+                logger.debug('Metadata not modified since last collection')
+                return self.last_list
             content.raise_for_status()
+            response_headers = content.headers or {}
+            try:
+                last_modified = self.check_fetch_content(response_headers)
+            except exc.RequestMetadataNotAvailable:
+                if self.last_list is None:
+                    raise
+                logger.debug('Metadata not modified since last collection')
+                return self.last_list
             self.last_modified = last_modified
 
         except self._requests_impl.exceptions.RequestException as e:
@@ -97,4 +154,12 @@ class Collector:
 
         final_list = merger.merged_list_from_content(
             final_content, cfg.CONF.deployment_key, name)
+        self.last_list = final_list
+        self.validators = {
+            'url': url,
+            'etag': response_headers.get('etag'),
+            'last-modified': response_headers.get('last-modified'),
+            'digest': cache.digest(final_content),
+        }
+        self._save_validators()
         return final_list
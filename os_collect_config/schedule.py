@@ -0,0 +1,148 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-collector polling schedules.
+
+Each collector is polled on its own exponential schedule, starting at its
+min-polling-interval and doubling after every poll up to its
+polling-interval. Collectors without their own settings use the global
+ones, so by default every collector is due at the same time.
+
+Collectors which have updates pushed to them call notify() to be polled
+straight away instead of waiting for their next interval.
+"""
+
+import os
+import random
+import threading
+
+from oslo_config import cfg
+
+CONF = cfg.CONF
+
+opts = [
+    cfg.FloatOpt('min-polling-interval',
+                 help='Minimum seconds between polls of this collector. '
+                      'Defaults to the global min-polling-interval.'),
+    cfg.FloatOpt('polling-interval',
+                 help='Maximum seconds between polls of this collector. '
+                      'Defaults to the global polling-interval.'),
+    cfg.FloatOpt('polling-jitter',
+                 default=0,
+                 min=0,
+                 help='Add a random delay of up to this many seconds to '
+                      'each interval between polls of this collector.'),
+]
+
+
+_notify_lock = threading.Lock()
+_notified = set()
+_notify_pipe = None
+
+
+def notify(collector):
+    '''Mark a collector as due and interrupt a wait on notify_fd().
+
+    Safe to call from any thread.
+    '''
+    with _notify_lock:
+        _notified.add(collector)
+        if _notify_pipe is not None:
+            try:
+                os.write(_notify_pipe[1], b'\0')
+            except BlockingIOError:
+                # The pipe is already readable
+                pass
+
+
+def notify_fd():
+    '''Return a file descriptor which is readable after notify().'''
+    global _notify_pipe
+    with _notify_lock:
+        if _notify_pipe is None:
+            _notify_pipe = os.pipe()
+            for fd in _notify_pipe:
+                os.set_blocking(fd, False)
+            if _notified:
+                os.write(_notify_pipe[1], b'\0')
+        return _notify_pipe[0]
+
+
+def listening():
+    '''Return True once something waits on notify_fd() for pushes.'''
+    with _notify_lock:
+        return _notify_pipe is not None
+
+
+def notified():
+    '''Return and forget the collectors notified since the last call.'''
+    with _notify_lock:
+        if _notify_pipe is not None:
+            try:
+                while os.read(_notify_pipe[0], 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        collectors = sorted(_notified)
+        _notified.clear()
+    return collectors
+
+
+def _group_opt(collector, name):
+    value = CONF[collector][name]
+    if value is None:
+        value = CONF[name]
+    return value
+
+
+class Scheduler:
+    '''Track which collectors are due to be polled.
+
+    Time only advances through slept(), so the time spent collecting does
+    not count towards the intervals, just as with a plain sleep between
+    polls.
+    '''
+    def __init__(self, collectors):
+        self.collectors = list(collectors)
+        self._interval = {c: _group_opt(c, 'min_polling_interval')
+                          for c in self.collectors}
+        self._remaining = {c: 0 for c in self.collectors}
+
+    def due(self):
+        return [c for c in self.collectors if self._remaining[c] <= 0]
+
+    def polled(self, collectors):
+        for collector in collectors:
+            interval = self._interval[collector]
+            jitter = CONF[collector].polling_jitter
+            if jitter:
+                interval += random.uniform(0, jitter)
+            self._remaining[collector] = interval
+            self._interval[collector] = min(
+                self._interval[collector] * 2,
+                _group_opt(collector, 'polling_interval'))
+
+    def wake(self, collectors):
+        for collector in collectors:
+            if collector in self._remaining:
+                self._remaining[collector] = 0
+
+    def next_sleep(self):
+        if not self._remaining:
+            return CONF.polling_interval
+        return max(min(self._remaining.values()), 0)
+
+    def slept(self, seconds):
+        for collector in self.collectors:
+            self._remaining[collector] -= seconds
@@ -13,8 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import json
 import os
+from unittest import mock
 
 import fixtures
 import testtools
@@ -98,5 +100,96 @@ class TestCache(testtools.TestCase):
         (changed, path) = cache.store('content', value2)
         self.assertFalse(changed)
 
+    def test_cache_digest(self):
+        (changed, path) = cache.store('foo', {'a': 1, 'b': 2})
+        cache.commit('foo')
+        with open('%s.last.sha256' % path) as f:
+            self.assertEqual(cache.digest({'b': 2, 'a': 1}), f.read())
+
+        # Change detection does not need to parse the .last file
+        with mock.patch.object(json, 'load') as load:
+            (changed, path) = cache.store('foo', {'b': 2, 'a': 1})
+            self.assertFalse(changed)
+            (changed, path) = cache.store('foo', {'a': 3})
+            self.assertTrue(changed)
+            self.assertFalse(load.called)
+
+    def test_digest_format(self):
+        # Hooks are documented to be able to compute this themselves
+        self.assertEqual(
+            hashlib.sha256(b'{"a":1,"b":[2,"c"]}').hexdigest(),
+            cache.digest({'b': [2, 'c'], 'a': 1}))
+
+    def test_cache_no_digest(self):
+        (changed, path) = cache.store('foo', {'a': 1})
+        cache.commit('foo')
+        # .last files from before digests were kept are parsed instead
+        os.unlink('%s.last.sha256' % path)
+        (changed, path) = cache.store('foo', {'a': 1})
+        self.assertFalse(changed)
+        (changed, path) = cache.store('foo', {'a': 2})
+        self.assertTrue(changed)
+
+    def test_cache_unchanged_not_rewritten(self):
+        (changed, path) = cache.store('foo', {'a': 1})
+        before = os.stat(path)
+        (changed, path) = cache.store('foo', {'a': 1})
+        self.assertTrue(changed)
+        after = os.stat(path)
+        self.assertEqual(before.st_ino, after.st_ino)
+        self.assertEqual(before.st_mtime_ns, after.st_mtime_ns)
+        self.assertEqual(cache.digest({'a': 1}), cache.get_file_digest(path))
+
+        (changed, path) = cache.store('foo', {'a': 2})
+        self.assertNotEqual(before.st_ino, os.stat(path).st_ino)
+        with open(path) as f:
+            self.assertEqual({'a': 2}, json.load(f))
+        self.assertEqual(cache.digest({'a': 2}), cache.get_file_digest(path))
+
+    def test_mirror(self):
+        backup_dir = os.path.join(self.cache_dir, '..', 'backup')
+        (changed, path) = cache.store('foo', {'a': 1})
+        cache.store('bar', {'b': 1})
+        os.mkdir(os.path.join(self.cache_dir, 'sub'))
+        with open(os.path.join(self.cache_dir, 'sub', 'baz'), 'w') as f:
+            f.write('baz')
+        cache.mirror(self.cache_dir, backup_dir)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         sorted(os.listdir(backup_dir)))
+        self.assertEqual(['baz'], os.listdir(os.path.join(backup_dir, 'sub')))
+        backup_path = os.path.join(backup_dir, 'foo.json')
+        with open(backup_path) as f:
+            self.assertEqual({'a': 1}, json.load(f))
+
+        # Only changed files are replaced, and removed files are removed
+        orig_st = os.stat('%s.orig' % backup_path)
+        cache.store('foo', {'a': 2})
+        os.unlink(cache.get_path('bar'))
+        cache.mirror(self.cache_dir, backup_dir)
+        with open(backup_path) as f:
+            self.assertEqual({'a': 2}, json.load(f))
+        self.assertFalse(os.path.exists(os.path.join(backup_dir, 'bar.json')))
+        self.assertEqual(orig_st.st_ino,
+                         os.stat('%s.orig' % backup_path).st_ino)
+
+    def test_mirror_commit(self):
+        backup_dir = os.path.join(self.cache_dir, '..', 'backup')
+        cache.store('foo', {'a': 1})
+        cache.commit('foo')
+        cache.mirror(self.cache_dir, backup_dir)
+        backup_last = os.path.join(backup_dir, 'foo.json.last')
+        cache.store('foo', {'a': 2})
+        cache.commit('foo')
+        # The backup copy is untouched until the next mirror
+        with open(backup_last) as f:
+            self.assertEqual({'a': 1}, json.load(f))
+        with open('%s.sha256' % backup_last) as f:
+            self.assertEqual(cache.digest({'a': 1}), f.read())
+        cache.mirror(self.cache_dir, backup_dir)
+        with open(backup_last) as f:
+            self.assertEqual({'a': 2}, json.load(f))
+        self.assertEqual(cache.digest({'a': 2}),
+                         cache.get_file_digest(backup_last))
+
     def test_commit_no_cache(self):
         self.assertIsNone(cache.commit('neversaved'))
@@ -15,6 +15,8 @@
 
 import json
 import tempfile
+import threading
+import time
 
 import fixtures
 from lxml import etree
@@ -109,13 +111,23 @@ SOFTWARE_CONFIG_IMPOSTER_DATA = {
 
 
 class FakeResponse(dict):
-    def __init__(self, text):
-        self.text = text
+    def __init__(self, content):
+        self.content = content
+        self.text = content.decode('utf-8')
 
     def raise_for_status(self):
         pass
 
 
+def describe_response(metadata_content):
+    root = etree.Element('DescribeStackResourceResponse')
+    result = etree.SubElement(root, 'DescribeStackResourceResult')
+    detail = etree.SubElement(result, 'StackResourceDetail')
+    metadata = etree.SubElement(detail, 'Metadata')
+    metadata.text = json.dumps(metadata_content)
+    return FakeResponse(etree.tostring(root))
+
+
 class FakeReqSession:
 
     SESSION_META_DATA = META_DATA
@@ -141,14 +153,9 @@ class FakeReqSession:
         self._test.assertIn('LogicalResourceId', params)
         self._test.assertEqual('foo', params['LogicalResourceId'])
         self._test.assertEqual(10, timeout)
-        root = etree.Element('DescribeStackResourceResponse')
-        result = etree.SubElement(root, 'DescribeStackResourceResult')
-        detail = etree.SubElement(result, 'StackResourceDetail')
-        metadata = etree.SubElement(detail, 'Metadata')
-        metadata.text = json.dumps(self.SESSION_META_DATA)
         if verify is not None:
             self.verify = True
-        return FakeResponse(etree.tostring(root))
+        return describe_response(self.SESSION_META_DATA)
 
 
 class FakeRequests:
@@ -186,6 +193,46 @@ class FakeRequestsConfigImposter(FakeRequestsSoftwareConfig):
     FAKE_SESSION = FakeReqSessionConfigImposter
 
 
+class FakeMultiResourceRequests:
+    exceptions = requests.exceptions
+    delay = 0.05
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.described = []
+        self.active = 0
+        self.max_active = 0
+
+    def Session(self):
+        requests_impl = self
+
+        class Session:
+            def get(self, url, params, headers, verify=None, timeout=None):
+                resource = params['LogicalResourceId']
+                with requests_impl.lock:
+                    requests_impl.described.append(resource)
+                    requests_impl.active += 1
+                    requests_impl.max_active = max(
+                        requests_impl.max_active, requests_impl.active)
+                try:
+                    time.sleep(requests_impl.delay)
+                    return describe_response(
+                        {resource: META_DATA['map_ab']})
+                finally:
+                    with requests_impl.lock:
+                        requests_impl.active -= 1
+
+        return Session()
+
+
+class FakeInvalidRequests:
+    exceptions = requests.exceptions
+
+    class Session:
+        def get(self, url, params, headers, verify=None, timeout=None):
+            return FakeResponse(b'<DescribeStackResourceResponse>')
+
+
 class FakeFailRequests:
     exceptions = requests.exceptions
 
@@ -235,12 +282,48 @@ class TestCfn(TestCfnBase):
         self.assertRaises(exc.CfnMetadataNotAvailable, cfn_collect.collect)
         self.assertIn('Forbidden', self.log.output)
 
+    def test_collect_cfn_invalid_response(self):
+        cfn_collect = cfn.Collector(requests_impl=FakeInvalidRequests)
+        self.assertRaises(exc.CfnMetadataNotAvailable, cfn_collect.collect)
+        self.assertIn('Invalid DescribeStackResource response',
+                      self.log.output)
+
+    def test_collect_cfn_missing_field(self):
+        cfg.CONF.cfn.path = ['foo.Missing']
+        cfn_collect = cfn.Collector(requests_impl=FakeRequests(self))
+        self.assertRaises(exc.CfnMetadataNotAvailable, cfn_collect.collect)
+        self.assertIn('Path foo.Missing does not exist', self.log.output)
+
+    def test_extract(self):
+        content = (
+            b'<DescribeStackResourceResponse>'
+            b'<Metadata>"decoy"</Metadata>'
+            b'<DescribeStackResourceResult><StackResourceDetail>'
+            b'<LogicalResourceId>foo</LogicalResourceId>'
+            b'<Metadata>{"a": "apple"}</Metadata>'
+            b'<ResourceStatus>CREATE_COMPLETE</ResourceStatus>'
+            b'</StackResourceDetail></DescribeStackResourceResult>'
+            b'</DescribeStackResourceResponse>')
+        cfn_collect = cfn.Collector(requests_impl=FakeRequests(self))
+        self.assertEqual(
+            {'Metadata': '{"a": "apple"}'},
+            cfn_collect._extract(content, ['Metadata']))
+        self.assertEqual(
+            {'Metadata': '{"a": "apple"}',
+             'ResourceStatus': 'CREATE_COMPLETE'},
+            cfn_collect._extract(content, ['Metadata', 'ResourceStatus']))
+
     def test_collect_cfn_no_path(self):
         cfg.CONF.cfn.path = None
         cfn_collect = cfn.Collector(requests_impl=FakeRequests(self))
         self.assertRaises(exc.CfnMetadataNotConfigured, cfn_collect.collect)
         self.assertIn('No path configured', self.log.output)
 
+    def test_collect_cfn_empty_path(self):
+        cfg.CONF.cfn.path = []
+        cfn_md = cfn.Collector(requests_impl=FakeRequests(self)).collect()
+        self.assertEqual([('cfn', {})], cfn_md)
+
     def test_collect_cfn_bad_path(self):
         cfg.CONF.cfn.path = ['foo']
         cfn_collect = cfn.Collector(requests_impl=FakeRequests(self))
@@ -269,6 +352,17 @@ class TestCfn(TestCfnBase):
         self.assertIn('b', content)
         self.assertEqual('banana', content['b'])
 
+    def test_collect_cfn_resource_described_once(self):
+        cfg.CONF.cfn.path = ['foo.Metadata', 'bar.Metadata.bar',
+                             'foo.Metadata.foo']
+        requests_impl = FakeMultiResourceRequests()
+        content = cfn.Collector(requests_impl=requests_impl).collect()
+        self.assertEqual(
+            {'foo': META_DATA['map_ab'], 'a': 'apple', 'b': 'banana'},
+            content[0][1])
+        self.assertEqual(['bar', 'foo'], sorted(requests_impl.described))
+        self.assertEqual(2, requests_impl.max_active)
+
     def test_collect_cfn_metadata_url_overrides_hint(self):
         cfg.CONF.cfn.metadata_url = 'http://127.0.1.1:8000/v1/'
         cfn_collect = cfn.Collector(
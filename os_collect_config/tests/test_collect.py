@@ -16,9 +16,13 @@
 import copy
 import json
 import os
+import shutil
 import signal
+import subprocess
 import sys
 import tempfile
+import threading
+import time
 from unittest import mock
 
 import fixtures
@@ -30,6 +34,7 @@ from os_collect_config import cache
 from os_collect_config import collect
 from os_collect_config import config_drive
 from os_collect_config import exc
+from os_collect_config import schedule
 from os_collect_config.tests import test_cfn
 from os_collect_config.tests import test_ec2
 from os_collect_config.tests import test_heat
@@ -37,6 +42,7 @@ from os_collect_config.tests import test_heat_local
 from os_collect_config.tests import test_local
 from os_collect_config.tests import test_request
 from os_collect_config.tests import test_zaqar
+from os_collect_config import zaqar
 
 
 def _setup_heat_local_metadata(test_case):
@@ -56,6 +62,30 @@ def _setup_local_metadata(test_case):
     return tmpdir.path
 
 
+class FakePluginCollector:
+    def __init__(self, requests_impl=None):
+        pass
+
+    def collect(self):
+        return [('plugin', {'greeting': cfg.CONF.plugin.greeting})]
+
+
+class FakePluginModule:
+    opts = [cfg.StrOpt('greeting', default='hello')]
+    Collector = FakePluginCollector
+
+
+class FakeEntryPoint:
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+
+    def load(self):
+        if self.module is None:
+            raise AssertionError('Unused plugin %s loaded' % self.name)
+        return self.module
+
+
 class TestCollect(testtools.TestCase):
 
     def setUp(self):
@@ -63,6 +93,7 @@ class TestCollect(testtools.TestCase):
         self.useFixture(fixtures.FakeLogger())
         collect.setup_conf()
         self.addCleanup(cfg.CONF.reset)
+        self.addCleanup(collect.reset_collectors)
 
     def _call_main(self, fake_args):
         # make sure we don't run forever!
@@ -193,6 +224,75 @@ class TestCollect(testtools.TestCase):
         calls = self._fake_popen_call_main(occ_args)
         self.assertIn('OS_CONFIG_FILES', calls[0]['env'])
 
+    def test_main_export_changed_files(self):
+        cache_dir = self.useFixture(fixtures.TempDir())
+        backup_cache_dir = self.useFixture(fixtures.TempDir())
+        fake_metadata = _setup_heat_local_metadata(self)
+        occ_args = [
+            'os-collect-config',
+            '--command', 'foo',
+            '--cachedir', cache_dir.path,
+            '--backup-cachedir', backup_cache_dir.path,
+            '--config-file', '/dev/null',
+            '--heat_local-path', fake_metadata,
+            '--local-path', _setup_local_metadata(self),
+            '--export-changed-files',
+            'heat_local', 'local',
+        ]
+        heat_local_path = os.path.join(cache_dir.path, 'heat_local.json')
+        local_path = os.path.join(cache_dir.path, 'local.json')
+        calls = self._fake_popen_call_main(list(occ_args))
+        env = calls[0]['env']
+        self.assertEqual(heat_local_path + ':' + local_path,
+                         env['OS_CONFIG_FILES'])
+        self.assertEqual(env['OS_CONFIG_FILES'],
+                         env['OS_CONFIG_CHANGED_FILES'])
+
+        with open(fake_metadata, 'w') as f:
+            json.dump({'changed': True}, f)
+        cfg.CONF.reset()
+        calls = self._fake_popen_call_main(list(occ_args))
+        env = calls[0]['env']
+        self.assertEqual(heat_local_path, env['OS_CONFIG_CHANGED_FILES'])
+        self.assertEqual(
+            [cache.digest({'changed': True}),
+             cache.digest(test_local.META_DATA)],
+            env['OS_CONFIG_FILE_DIGESTS'].split(':'))
+
+        # A forced run lists every file as changed
+        cfg.CONF.reset()
+        calls = self._fake_popen_call_main(occ_args + ['--force'])
+        env = calls[0]['env']
+        self.assertEqual(env['OS_CONFIG_FILES'],
+                         env['OS_CONFIG_CHANGED_FILES'])
+
+    def test_main_metrics(self):
+        cache_dir = self.useFixture(fixtures.TempDir())
+        textfile = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                'occ.prom')
+        occ_args = [
+            'os-collect-config',
+            '--command', 'foo',
+            '--cachedir', cache_dir.path,
+            '--backup-cachedir', cache_dir.path + '.bak',
+            '--config-file', '/dev/null',
+            '--heat_local-path', _setup_heat_local_metadata(self),
+            '--write-stats',
+            '--prometheus-textfile', textfile,
+            'heat_local',
+        ]
+        self.addCleanup(shutil.rmtree, cache_dir.path + '.bak', True)
+        self._fake_popen_call_main(occ_args)
+        with open(os.path.join(cache_dir.path,
+                               'os_collect_config_stats.json')) as f:
+            stats = json.load(f)
+        self.assertEqual(['collect', 'command', 'commit', 'mirror', 'store'],
+                         sorted(stats['phases']))
+        self.assertEqual(['heat_local'], list(stats['collectors']))
+        self.assertEqual(1, stats['keys_changed'])
+        self.assertEqual(0, stats['cache_hits'])
+        self.assertTrue(os.path.exists(textfile))
+
     def test_main_command_failed_no_caching(self):
         cache_dir = self.useFixture(fixtures.TempDir())
         backup_cache_dir = self.useFixture(fixtures.TempDir())
@@ -307,6 +407,56 @@ class TestCollect(testtools.TestCase):
         fake_args = ['os-collect-config', 'invalid']
         self.assertRaises(exc.InvalidArguments, self._call_main, fake_args)
 
+    def test_main_plugin_collector(self):
+        self.useFixture(fixtures.MockPatchObject(
+            collect, '_entry_points',
+            lambda group: [FakeEntryPoint('plugin', FakePluginModule),
+                           FakeEntryPoint('unused', None)]))
+        self.useFixture(fixtures.MockPatchObject(
+            collect, 'COLLECTORS', collect.CollectorRegistry(
+                (name, 'os_collect_config.%s' % name)
+                for name in collect.BUILTIN_COLLECTORS)))
+        config_file = self.useFixture(fixtures.TempDir()).join('occ.conf')
+        with open(config_file, 'w') as f:
+            f.write('[plugin]\ngreeting = hi\n')
+        output = self.useFixture(fixtures.StringStream('stdout'))
+        self.useFixture(
+            fixtures.MonkeyPatch('sys.stdout', output.stream))
+        self._call_main(['os-collect-config', 'plugin', '--print',
+                         '--config-file', config_file])
+        out_struct = json.loads(output.getDetails()['stdout'].as_text())
+        self.assertEqual({'plugin': {'greeting': 'hi'}}, out_struct)
+
+    def test_main_parallel_timeout_exits(self):
+        # A one-time run exits at the deadline, not when a hung collector
+        # finally returns
+        script = '''
+import sys
+import time
+
+from os_collect_config import collect
+
+
+class HungModule:
+    class Collector:
+        def __init__(self, **kwargs):
+            pass
+
+        def collect(self):
+            time.sleep(60)
+
+
+collect.COLLECTORS = dict(collect.COLLECTORS, hung=HungModule)
+sys.exit(collect.main(['os-collect-config', 'hung', '--print',
+                       '--parallel', '--collect-timeout', '0.2',
+                       '--config-file', '/dev/null']))
+'''
+        start = time.monotonic()
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         timeout=30)
+        self.assertLess(time.monotonic() - start, 20)
+        self.assertEqual({}, json.loads(output))
+
     def test_main_sleep(self):
         class ExpectedException(Exception):
             pass
@@ -343,6 +493,155 @@ class TestCollect(testtools.TestCase):
                           ['os-collect-config', 'heat_local', '-i', '10',
                            '--min-polling-interval', '20', '-c', 'true'])
 
+    def _coalesce_main(self, burst, window='30'):
+        # Runs main with a fake clock, calling burst before each sleep
+        class ExpectedException(Exception):
+            pass
+
+        cache_dir = self.useFixture(fixtures.TempDir())
+        fake_metadata = _setup_heat_local_metadata(self)
+        now = [0]
+        sleeps = []
+        calls = []
+
+        def fake_sleep(sleep_time):
+            sleeps.append(sleep_time)
+            if calls:
+                raise ExpectedException
+            now[0] += sleep_time
+            burst(fake_metadata, len(sleeps))
+
+        def capture_popen(proc_args):
+            calls.append(proc_args)
+            return dict(returncode=0)
+        self.useFixture(fixtures.FakePopen(capture_popen))
+        self.useFixture(fixtures.MonkeyPatch('time.sleep', fake_sleep))
+        self.useFixture(fixtures.MonkeyPatch('time.monotonic',
+                                             lambda: now[0]))
+        self.assertRaises(ExpectedException, collect.main,
+                          ['os-collect-config', 'heat_local',
+                           '--heat_local-path', fake_metadata,
+                           '--cachedir', cache_dir.path,
+                           '--backup-cachedir', cache_dir.path + '.bak',
+                           '--config-file', '/dev/null',
+                           '--coalesce-window', window,
+                           '-i', '10', '-c', 'true'])
+        self.addCleanup(shutil.rmtree, cache_dir.path + '.bak', True)
+        with open(os.path.join(cache_dir.path, 'heat_local.json')) as f:
+            return calls, sleeps, json.load(f)
+
+    def test_main_coalesce(self):
+        def burst(path, count):
+            if count < 3:
+                with open(path, 'w') as f:
+                    json.dump({'count': count}, f)
+
+        calls, sleeps, content = self._coalesce_main(burst)
+        self.assertEqual(1, len(calls))
+        self.assertEqual({'count': 2}, content)
+        self.assertEqual([1, 1, 1, 8], sleeps)
+
+    def test_main_coalesce_window(self):
+        def burst(path, count):
+            with open(path, 'w') as f:
+                json.dump({'count': count}, f)
+
+        calls, sleeps, content = self._coalesce_main(burst, window='2.5')
+        self.assertEqual(1, len(calls))
+        self.assertEqual({'count': 3}, content)
+        self.assertEqual([1, 1, 0.5, 8], sleeps)
+
+    def test_main_watch(self):
+        class ExpectedException(Exception):
+            pass
+
+        waits = []
+
+        def fake_wait(self, timeout, fds=()):
+            waits.append(timeout)
+            raise ExpectedException
+
+        def fake_sleep(sleep_time):
+            self.fail('Slept instead of waiting for changes')
+
+        local_path = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.MonkeyPatch('time.sleep', fake_sleep))
+        self.useFixture(fixtures.MockPatchObject(
+            collect.inotify.Watcher, 'wait', fake_wait))
+        self.assertRaises(ExpectedException, collect.main,
+                          ['os-collect-config', 'local', '--watch',
+                           '--local-path', local_path,
+                           '--config-file', '/dev/null',
+                           '--min-polling-interval', '20', '-c', 'true'])
+        self.assertEqual([20], waits)
+
+    def test_main_push(self):
+        class ExpectedException(Exception):
+            pass
+
+        collected = []
+
+        def fake_collect_all(collectors, store=False,
+                             collector_kwargs_map=None, due=None):
+            collected.append(due)
+            if len(collected) == 1:
+                schedule.notify('zaqar')
+            elif len(collected) == 2:
+                raise ExpectedException
+            return (set(), [])
+
+        def fake_sleep(sleep_time):
+            self.fail('Slept instead of waiting for pushed updates')
+
+        self.useFixture(fixtures.MonkeyPatch('time.sleep', fake_sleep))
+        self.useFixture(fixtures.MockPatchObject(
+            collect, 'collect_all', fake_collect_all))
+        self.useFixture(fixtures.MockPatchObject(
+            zaqar, 'pushes', return_value=True))
+        self.addCleanup(schedule.notified)
+        self.assertRaises(ExpectedException, collect.main,
+                          ['os-collect-config', 'zaqar', 'local',
+                           '--config-file', '/dev/null',
+                           '--min-polling-interval', '20', '-c', 'true'])
+        self.assertEqual([['zaqar', 'local'], ['zaqar']], collected)
+
+    def test_watched_paths(self):
+        cfg.CONF.set_override('path', ['/a/local'], group='local')
+        cfg.CONF.set_override('path', ['/a/heat/md'], group='heat_local')
+        self.assertEqual(
+            [('/a/local', None), ('/a/heat', 'md')],
+            collect.watched_paths(['ec2', 'local', 'heat_local']))
+
+    def test_main_per_collector_schedule(self):
+        class ExpectedException(Exception):
+            pass
+
+        sleeps = []
+        collected = []
+
+        def fake_sleep(sleep_time):
+            sleeps.append(sleep_time)
+            if len(sleeps) == 5:
+                raise ExpectedException
+
+        def fake_collect_all(collectors, store=False,
+                             collector_kwargs_map=None, due=None):
+            collected.append(due)
+            return (set(), [])
+
+        self.useFixture(fixtures.MonkeyPatch('time.sleep', fake_sleep))
+        self.useFixture(fixtures.MockPatchObject(
+            collect, 'collect_all', fake_collect_all))
+        self.assertRaises(ExpectedException, collect.main,
+                          ['os-collect-config', 'heat_local', 'local',
+                           '--config-file', '/dev/null',
+                           '-i', '4', '--heat_local-polling-interval', '8',
+                           '--heat_local-min-polling-interval', '8',
+                           '-c', 'true'])
+        self.assertEqual([1, 2, 4, 1, 3], sleeps)
+        self.assertEqual([['heat_local', 'local'], ['local'], ['local'],
+                          ['local'], ['heat_local']], collected)
+
     @mock.patch('time.sleep')
     @mock.patch('random.randrange')
     def test_main_with_splay(self, randrange_mock, sleep_mock):
@@ -360,6 +659,7 @@ class TestCollectAll(testtools.TestCase):
         super().setUp()
         self.log = self.useFixture(fixtures.FakeLogger())
         collect.setup_conf()
+        self.addCleanup(collect.reset_collectors)
         self.cache_dir = self.useFixture(fixtures.TempDir())
         self.backup_cache_dir = self.useFixture(fixtures.TempDir())
         self.clean_conf = copy.copy(cfg.CONF)
@@ -390,6 +690,10 @@ class TestCollectAll(testtools.TestCase):
         cfg.CONF.zaqar.project_id = '9f6b09df-4d7f-4a33-8ec3-9924d8f46f10'
         cfg.CONF.zaqar.queue_id = '4f3f46d3-09f1-42a7-8c13-f91a5457192c'
 
+    def _set_conf(self, name, value):
+        setattr(collect.CONF, name, value)
+        self.addCleanup(delattr, collect.CONF, name)
+
     def _call_collect_all(self, store, collector_kwargs_map=None,
                           collectors=None):
         if collector_kwargs_map is None:
@@ -517,6 +821,96 @@ class TestCollectAll(testtools.TestCase):
         # failure
         self.assertEqual(paths, paths2)
 
+    def test_collect_all_reuses_collectors(self):
+        collector_kwargs_map = {
+            'ec2': {'requests_impl': test_ec2.FakeRequests},
+            'request': {'requests_impl': test_request.FakeRequests},
+        }
+        collectors = ['ec2', 'request', 'local']
+        self._call_collect_all(store=True, collectors=collectors,
+                               collector_kwargs_map=collector_kwargs_map)
+        instances = [collect.get_collector(c, collector_kwargs_map.get(c))
+                     for c in collectors]
+        self._call_collect_all(store=True, collectors=collectors,
+                               collector_kwargs_map=collector_kwargs_map)
+        for collector, instance in zip(collectors, instances):
+            self.assertIs(instance, collect.get_collector(
+                collector, collector_kwargs_map.get(collector)))
+
+        # Different constructor arguments build a new instance
+        self.assertIsNot(instances[0], collect.get_collector(
+            'ec2', {'requests_impl': test_ec2.FakeFailRequests}))
+
+        collect.reset_collectors()
+        self.assertIsNot(instances[2], collect.get_collector('local'))
+
+    def test_collect_all_not_due(self):
+        (changed_keys, paths) = self._call_collect_all(store=True)
+        for changed in changed_keys:
+            cache.commit(changed)
+        # Collectors which are not due reuse their previous result, even
+        # when they would now fail
+        collector_kwargs_map = {
+            'ec2': {'requests_impl': test_ec2.FakeFailRequests},
+            'request': {'requests_impl': test_request.FakeFailRequests},
+        }
+        with mock.patch.object(config_drive, 'get_metadata') as gm:
+            gm.return_value = {}
+            (changed_keys, paths2) = collect.collect_all(
+                cfg.CONF.collectors, store=True,
+                collector_kwargs_map=collector_kwargs_map,
+                due=['heat_local', 'local'])
+        self.assertEqual(set(), changed_keys)
+        self.assertEqual(paths, paths2)
+
+    def test_collect_all_parallel(self):
+        (changed_keys, paths) = self._call_collect_all(store=True)
+        self._set_conf('parallel', True)
+        new_list = list(reversed(cfg.CONF.collectors))
+        (changed_keys, parallel_paths) = self._call_collect_all(
+            store=True, collectors=new_list)
+        self.assertEqual(set(cfg.CONF.collectors), changed_keys)
+        self.assertEqual(list(reversed(paths)), parallel_paths)
+
+    def test_collect_all_parallel_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        class SlowCollector:
+            def __init__(self, requests_impl=None):
+                pass
+
+            def collect(self):
+                release.wait()
+                return [('slow', {'a': 1})]
+
+        class SlowModule:
+            Collector = SlowCollector
+
+        self.useFixture(fixtures.MockPatchObject(
+            collect, '_in_flight', {}))
+        self.useFixture(fixtures.MockPatchObject(
+            collect, 'COLLECTORS', dict(collect.COLLECTORS, slow=SlowModule)))
+        self._set_conf('parallel', True)
+        self._set_conf('collect_timeout', 0.1)
+        (changed_keys, content) = self._call_collect_all(
+            store=False, collectors=['heat_local', 'slow'])
+        self.assertIn('Source [slow] timed out', self.log.output)
+        self.assertNotIn('slow', content)
+        self.assertIn('heat_local', content)
+
+        # The hung collector is not started a second time
+        (changed_keys, content) = self._call_collect_all(
+            store=False, collectors=['heat_local', 'slow'])
+        self.assertIn('Source [slow] still running', self.log.output)
+        self.assertIn('heat_local', content)
+
+        release.set()
+        collect._in_flight['slow'].result()
+        (changed_keys, content) = self._call_collect_all(
+            store=False, collectors=['heat_local', 'slow'])
+        self.assertEqual({'a': 1}, content['slow'])
+
     def test_collect_all_nostore(self):
         (changed_keys, content) = self._call_collect_all(store=False)
         self.assertEqual(set(), changed_keys)
@@ -559,6 +953,44 @@ class TestConf(testtools.TestCase):
         self.assertTrue(hasattr(cfg.CONF, 'ec2'))
         self.assertTrue(hasattr(cfg.CONF, 'cfn'))
 
+    def test_setup_conf_defers_client_imports(self):
+        script = ('import sys; from os_collect_config import collect; '
+                  'collect.setup_conf(); '
+                  'print(" ".join(sorted(sys.modules)))')
+        modules = subprocess.check_output(
+            [sys.executable, '-c', script]).decode().split()
+        for module in ('heatclient', 'keystoneclient', 'lxml', 'requests',
+                       'zaqarclient'):
+            self.assertNotIn(module, modules)
+
+
+class TestCollectorRegistry(testtools.TestCase):
+
+    def test_builtins_without_entry_points(self):
+        def fake_entry_points(group):
+            raise AssertionError('Entry points scanned')
+        self.useFixture(fixtures.MockPatchObject(
+            collect, '_entry_points', fake_entry_points))
+        registry = collect.CollectorRegistry(
+            [('local', 'os_collect_config.local')])
+        self.assertIn('local', registry)
+        self.assertIs(sys.modules['os_collect_config.local'],
+                      registry['local'])
+
+    def test_entry_points(self):
+        self.useFixture(fixtures.MockPatchObject(
+            collect, '_entry_points',
+            lambda group: [FakeEntryPoint('plugin', FakePluginModule),
+                           FakeEntryPoint('local', None)]))
+        registry = collect.CollectorRegistry(
+            [('local', 'os_collect_config.local')])
+        self.assertEqual(['local', 'plugin'], sorted(registry))
+        self.assertNotIn('other', registry)
+        self.assertIs(FakePluginModule, registry['plugin'])
+        # A plugin can not replace a built in collector
+        self.assertIs(sys.modules['os_collect_config.local'],
+                      registry['local'])
+
 
 class TestHup(testtools.TestCase):
 
@@ -585,6 +1017,13 @@ class TestHup(testtools.TestCase):
         collect.reexec_self()
         self.assertNotIn('Signal received', self.log.output)
 
+    def test_reexec_self_resets_collectors(self):
+        collect.setup_conf()
+        self.addCleanup(cfg.CONF.reset)
+        collect.get_collector('local')
+        collect.reexec_self(signal.SIGHUP, None)
+        self.assertEqual({}, collect._collectors)
+
 
 class TestFileHash(testtools.TestCase):
     def setUp(self):
@@ -618,3 +1057,30 @@ class TestFileHash(testtools.TestCase):
             collect.getfilehash([self.file_1, self.file_2]),
             collect.getfilehash([self.file_1, "/i/dont/exist", self.file_2])
         )
+
+    def test_getfilestats(self):
+        st = os.stat(self.file_1)
+        self.assertEqual(
+            [(st.st_ino, st.st_size, st.st_mtime_ns), None],
+            collect.getfilestats([self.file_1, "/i/dont/exist"]))
+
+    def test_file_change_detector(self):
+        detector = collect.FileChangeDetector([self.file_1, self.file_2])
+        with mock.patch.object(collect, 'getfilehash',
+                               wraps=collect.getfilehash) as getfilehash:
+            self.assertFalse(detector.changed())
+            self.assertFalse(detector.changed())
+            # Unchanged stat results mean the files are not read
+            getfilehash.assert_not_called()
+
+            # Touched but with the same contents
+            st = os.stat(self.file_1)
+            os.utime(self.file_1, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+            self.assertFalse(detector.changed())
+            self.assertEqual(1, getfilehash.call_count)
+            self.assertFalse(detector.changed())
+            self.assertEqual(1, getfilehash.call_count)
+
+            with open(self.file_2, "w") as fp:
+                fp.write("test string3")
+            self.assertTrue(detector.changed())
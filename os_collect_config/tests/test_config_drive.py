@@ -35,11 +35,28 @@ TYPE=xfs
 '''
 
 
+UDEV_CONFIG_DRIVE = '''S:disk/by-label/config-2
+S:disk/by-uuid/2016-09-12-02-14-09-00
+I:1234567
+E:ID_CDROM=1
+E:ID_FS_UUID=2016-09-12-02-14-09-00
+E:ID_FS_LABEL=config-2
+E:ID_FS_TYPE=iso9660
+G:systemd
+'''
+
+
 class TestConfigDrive(testtools.TestCase):
 
     def setUp(self):
         super().setUp()
         self.log = self.useFixture(fixtures.FakeLogger())
+        # Without udev every device is probed by blkid
+        missing = os.path.join(self.useFixture(fixtures.TempDir()).path, 'x')
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_collect_config.config_drive.DEV_DISK_PATH', missing))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_collect_config.config_drive.UDEV_DATA_PATH', missing))
 
     @mock.patch.object(subprocess, 'check_output')
     def test_all_devices(self, co):
@@ -69,6 +86,15 @@ class TestConfigDrive(testtools.TestCase):
         self.assertEqual('/dev/sr0: TYPE="iso9660" LABEL="config-2"',
                          str(bd))
 
+    def test_from_udev_data(self):
+        bd = config_drive.BlockDevice.from_udev_data(
+            '/dev/sr0', UDEV_CONFIG_DRIVE)
+        self.assertEqual('/dev/sr0', bd.devname)
+        self.assertEqual('iso9660', bd.type)
+        self.assertEqual('config-2', bd.label)
+        self.assertEqual('2016-09-12-02-14-09-00', bd.uuid)
+        self.assertTrue(bd.config_drive_candidate())
+
     def test_parse_shell_var(self):
         psv = config_drive.BlockDevice.parse_shell_var
         self.assertEqual(('foo', 'bar'), psv('foo=bar'))
@@ -148,3 +174,172 @@ class TestConfigDrive(testtools.TestCase):
 
         md = bd.get_metadata()
         self.assertEqual(test_ec2.META_DATA_RESOLVED, md)
+
+
+class TestUdevProbe(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.log = self.useFixture(fixtures.FakeLogger())
+        root = self.useFixture(fixtures.TempDir()).path
+        self.sys_dev_block = os.path.join(root, 'sys', 'dev', 'block')
+        self.dev_disk = os.path.join(root, 'dev', 'disk')
+        self.udev_data = os.path.join(root, 'run', 'udev', 'data')
+        for path in (self.sys_dev_block, self.dev_disk, self.udev_data):
+            os.makedirs(path)
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_collect_config.config_drive.SYS_DEV_BLOCK_PATH',
+            self.sys_dev_block))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_collect_config.config_drive.DEV_DISK_PATH', self.dev_disk))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_collect_config.config_drive.UDEV_DATA_PATH', self.udev_data))
+        # A regular file stands in for the device node
+        self.devname = os.path.join(root, 'dev', 'sr0')
+        open(self.devname, 'w').close()
+        rdev = os.stat(self.devname).st_rdev
+        self.udev_entry = os.path.join(
+            self.udev_data, 'b%d:%d' % (os.major(rdev), os.minor(rdev)))
+
+    def _label_link(self):
+        os.makedirs(os.path.join(self.dev_disk, 'by-label'))
+        os.symlink(self.devname,
+                   os.path.join(self.dev_disk, 'by-label', 'config-2'))
+
+    @mock.patch.object(subprocess, 'check_output')
+    def test_by_label_udev(self, co):
+        self._label_link()
+        with open(self.udev_entry, 'w') as f:
+            f.write(UDEV_CONFIG_DRIVE)
+        bd = config_drive.config_drive()
+        self.assertEqual(self.devname, bd.devname)
+        self.assertTrue(bd.config_drive_candidate())
+        co.assert_not_called()
+
+    @mock.patch.object(subprocess, 'check_output')
+    def test_by_label_blkid(self, co):
+        self._label_link()
+        co.return_value = BLKID_CONFIG_DRIVE
+        bd = config_drive.config_drive()
+        self.assertTrue(bd.config_drive_candidate())
+        # Only the labelled device is probed
+        co.assert_called_once_with(
+            ['blkid', '-o', 'export', self.devname], universal_newlines=True)
+
+    @mock.patch.object(subprocess, 'check_output')
+    def test_udev_database(self, co):
+        os.makedirs(os.path.join(self.sys_dev_block, '11:0'))
+        with open(os.path.join(self.sys_dev_block, '11:0', 'uevent'),
+                  'w') as f:
+            f.write('MAJOR=11\nMINOR=0\nDEVNAME=sr0\nDEVTYPE=disk\n')
+        with open(os.path.join(self.udev_data, 'b11:0'), 'w') as f:
+            f.write(UDEV_CONFIG_DRIVE)
+        with open(os.path.join(self.udev_data, 'b253:1'), 'w') as f:
+            f.write('E:ID_FS_TYPE=xfs\n')
+        with open(os.path.join(self.udev_data, 'c4:1'), 'w') as f:
+            f.write('E:ID_FS_LABEL=config-2\n')
+        bd = config_drive.config_drive()
+        self.assertEqual('/dev/sr0', bd.devname)
+        self.assertEqual('2016-09-12-02-14-09-00', bd.uuid)
+        co.assert_not_called()
+
+    @mock.patch.object(subprocess, 'check_output')
+    def test_no_config_drive(self, co):
+        with open(self.udev_entry, 'w') as f:
+            f.write('E:ID_FS_TYPE=xfs\n')
+        self.assertIsNone(config_drive.config_drive())
+        co.assert_not_called()
+
+
+class TestDiscoveryCache(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.log = self.useFixture(fixtures.FakeLogger())
+        root = self.useFixture(fixtures.TempDir()).path
+        self.sys_block = os.path.join(root, 'sys', 'class', 'block')
+        sys_dev_block = os.path.join(root, 'sys', 'dev', 'block')
+        self.dev_disk = os.path.join(root, 'dev', 'disk')
+        for path in (self.sys_block, sys_dev_block, self.dev_disk):
+            os.makedirs(path)
+        for name in ('sr0', 'vda'):
+            os.mkdir(os.path.join(self.sys_block, name))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_collect_config.config_drive.SYS_BLOCK_PATH', self.sys_block))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_collect_config.config_drive.SYS_DEV_BLOCK_PATH',
+            sys_dev_block))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_collect_config.config_drive.DEV_DISK_PATH', self.dev_disk))
+
+        # A regular file stands in for the device node
+        self.devname = os.path.join(root, 'dev', 'sr0')
+        open(self.devname, 'w').close()
+        rdev = os.stat(self.devname).st_rdev
+        size_dir = os.path.join(
+            sys_dev_block, '%d:%d' % (os.major(rdev), os.minor(rdev)))
+        os.makedirs(size_dir)
+        self.size_path = os.path.join(size_dir, 'size')
+        with open(self.size_path, 'w') as f:
+            f.write('880\n')
+
+        self.bd = config_drive.BlockDevice.from_blkid_export(
+            BLKID_CONFIG_DRIVE.replace('/dev/sr0', self.devname))
+        self.cache = config_drive.DiscoveryCache()
+
+    def _link(self, kind, name, target):
+        links = os.path.join(self.dev_disk, kind)
+        os.makedirs(links, exist_ok=True)
+        os.symlink(target, os.path.join(links, name))
+
+    @mock.patch.object(config_drive, 'config_drive')
+    def test_no_config_drive(self, cd):
+        cd.return_value = None
+        self.assertEqual({}, config_drive.get_metadata(cache=self.cache))
+        self.assertEqual({}, config_drive.get_metadata(cache=self.cache))
+        self.assertEqual(1, cd.call_count)
+
+        # A new block device is probed
+        os.mkdir(os.path.join(self.sys_block, 'vdb'))
+        self.assertEqual({}, config_drive.get_metadata(cache=self.cache))
+        self.assertEqual(2, cd.call_count)
+
+        # As is a new config-2 label
+        self._link('by-label', 'config-2', self.devname)
+        self.assertEqual({}, config_drive.get_metadata(cache=self.cache))
+        self.assertEqual(3, cd.call_count)
+
+    @mock.patch.object(config_drive, 'config_drive')
+    def test_config_drive(self, cd):
+        cd.return_value = self.bd
+        self._link('by-label', 'config-2', self.devname)
+        self._link('by-uuid', self.bd.uuid, self.devname)
+        with mock.patch.object(self.bd, 'get_metadata') as gm:
+            gm.return_value = test_ec2.META_DATA_RESOLVED
+            for i in range(2):
+                self.assertEqual(
+                    test_ec2.META_DATA_RESOLVED,
+                    config_drive.get_metadata(cache=self.cache))
+            self.assertEqual(1, cd.call_count)
+            self.assertEqual(1, gm.call_count)
+
+            # A different size means different media
+            with open(self.size_path, 'w') as f:
+                f.write('1024\n')
+            config_drive.get_metadata(cache=self.cache)
+            config_drive.get_metadata(cache=self.cache)
+            self.assertEqual(2, cd.call_count)
+
+            # The UUID no longer refers to this device
+            os.unlink(os.path.join(self.dev_disk, 'by-uuid', self.bd.uuid))
+            config_drive.get_metadata(cache=self.cache)
+            self.assertEqual(3, cd.call_count)
+
+    @mock.patch.object(config_drive, 'config_drive')
+    def test_failure_not_cached(self, cd):
+        cd.return_value = self.bd
+        with mock.patch.object(self.bd, 'get_metadata') as gm:
+            gm.return_value = {}
+            config_drive.get_metadata(cache=self.cache)
+            config_drive.get_metadata(cache=self.cache)
+            self.assertEqual(2, gm.call_count)
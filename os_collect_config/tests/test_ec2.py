@@ -15,6 +15,8 @@
 
 import json
 import os
+import threading
+import time
 from unittest import mock
 import uuid
 
@@ -104,6 +106,33 @@ class FakeRequests:
             return FakeResponse(META_DATA[path])
 
 
+class FakeSlowRequests:
+    exceptions = requests.exceptions
+
+    class Session(FakeRequests.Session):
+        delay = 0.05
+
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.active = 0
+            self.max_active = 0
+            self.timeouts = []
+
+        def get(self, url, timeout=None):
+            with self.lock:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+                self.timeouts.append(timeout)
+            try:
+                if timeout < self.delay:
+                    raise requests.exceptions.Timeout(url)
+                time.sleep(self.delay)
+                return super().get(url, timeout)
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+
 class FakeFailRequests:
     exceptions = requests.exceptions
 
@@ -133,6 +162,27 @@ class TestEc2(testtools.TestCase):
         self.assertRaises(exc.Ec2MetadataNotAvailable, collect_ec2.collect)
         self.assertIn('Forbidden', self.log.output)
 
+    @mock.patch.object(config_drive, 'config_drive')
+    def test_collect_ec2_concurrent(self, cd):
+        cd.return_value = None
+        collect.setup_conf()
+        collect_ec2 = ec2.Collector(requests_impl=FakeSlowRequests)
+        self.assertEqual([('ec2', META_DATA_RESOLVED)], collect_ec2.collect())
+        self.assertGreater(collect_ec2.session.max_active, 1)
+        self.assertLessEqual(collect_ec2.session.max_active,
+                             cfg.CONF.ec2.workers)
+
+    @mock.patch.object(config_drive, 'config_drive')
+    def test_collect_ec2_crawl_timeout(self, cd):
+        cd.return_value = None
+        collect.setup_conf()
+        self.addCleanup(cfg.CONF.reset)
+        cfg.CONF.set_override('crawl_timeout', 0.08, group='ec2')
+        collect_ec2 = ec2.Collector(requests_impl=FakeSlowRequests)
+        self.assertRaises(exc.Ec2MetadataNotAvailable, collect_ec2.collect)
+        for timeout in collect_ec2.session.timeouts:
+            self.assertLessEqual(timeout, 0.08)
+
     @mock.patch.object(config_drive, 'config_drive')
     def test_collect_ec2_invalid_cache(self, cd):
         cd.return_value = None
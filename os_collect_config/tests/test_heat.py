@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import fixtures
+from heatclient import exc as heat_exc
 from keystoneclient import exceptions as ks_exc
 from oslo_config import cfg
 import testtools
@@ -97,6 +98,29 @@ class FakeKeystoneClient:
         return 'this is an auth_ref'
 
 
+class FakeCountingKeystoneDiscover(FakeKeystoneDiscover):
+    discovered = 0
+
+    def __init__(self, auth_url):
+        FakeCountingKeystoneDiscover.discovered += 1
+
+
+class FakeCountingKeystoneClient(FakeKeystoneClient):
+
+    def __init__(self, testcase, configs=None):
+        super().__init__(testcase, configs)
+        self.clients = 0
+        self.url_fors = 0
+
+    def Client(self, **kwargs):
+        self.clients += 1
+        return super().Client(**kwargs)
+
+    def url_for(self, **kwargs):
+        self.url_fors += 1
+        return super().url_for(**kwargs)
+
+
 class FakeFailKeystoneClient(FakeKeystoneClient):
 
     def Client(self, auth_url, user_id, password, project_id):
@@ -120,6 +144,12 @@ class FakeHeatClient:
         return META_DATA
 
 
+class FakeUnauthorizedHeatClient(FakeHeatClient):
+
+    def metadata(self, stack_id, resource_name):
+        raise heat_exc.HTTPUnauthorized()
+
+
 class FakeHeatClientSoftwareConfig(FakeHeatClient):
 
     def metadata(self, stack_id, resource_name):
@@ -159,6 +189,36 @@ class TestHeat(TestHeatBase):
             self.log.output == '' or
             self.log.output == 'Starting new HTTP connection (1): 192.0.2.1\n')
 
+    def test_collect_heat_reuses_keystone(self):
+        self.useFixture(fixtures.MockPatchObject(
+            FakeCountingKeystoneDiscover, 'discovered', 0))
+        ks_client = FakeCountingKeystoneClient(self)
+        heat_collect = heat.Collector(
+            keystoneclient=ks_client,
+            heatclient=FakeHeatClient(self),
+            discover_class=FakeCountingKeystoneDiscover)
+        heat_md = heat_collect.collect()
+        self.assertEqual(heat_md, heat_collect.collect())
+        self.assertEqual(1, FakeCountingKeystoneDiscover.discovered)
+        self.assertEqual(1, ks_client.clients)
+        self.assertEqual(1, ks_client.url_fors)
+
+    def test_collect_heat_unauthorized(self):
+        self.useFixture(fixtures.MockPatchObject(
+            FakeCountingKeystoneDiscover, 'discovered', 0))
+        ks_client = FakeCountingKeystoneClient(self)
+        heat_collect = heat.Collector(
+            keystoneclient=ks_client,
+            heatclient=FakeUnauthorizedHeatClient(self),
+            discover_class=FakeCountingKeystoneDiscover)
+        self.assertRaises(exc.HeatMetadataNotAvailable, heat_collect.collect)
+        heat_collect.heatclient = FakeHeatClient(self)
+        heat_collect.collect()
+        # The failed token is not reused, and the auth url is discovered
+        # again
+        self.assertEqual(2, ks_client.clients)
+        self.assertEqual(2, FakeCountingKeystoneDiscover.discovered)
+
     def test_collect_heat_fail(self):
         heat_collect = heat.Collector(
             keystoneclient=FakeFailKeystoneClient(self),
@@ -0,0 +1,82 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+
+import fixtures
+import testtools
+
+from os_collect_config import inotify
+
+
+class TestWatcher(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.log = self.useFixture(fixtures.FakeLogger())
+        self.tmpdir = self.useFixture(fixtures.TempDir()).path
+        self.watched = os.path.join(self.tmpdir, 'watched')
+        os.mkdir(self.watched)
+
+    def _watcher(self, paths):
+        watcher = inotify.watcher(paths)
+        if watcher is None:
+            self.skipTest('inotify is not available')
+        self.addCleanup(watcher.close)
+        return watcher
+
+    def _write_later(self, path):
+        def write():
+            time.sleep(0.05)
+            with open(path, 'w') as f:
+                f.write('{}')
+        thread = threading.Thread(target=write)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_wait_timeout(self):
+        watcher = self._watcher([(self.watched, None)])
+        start = time.monotonic()
+        self.assertFalse(watcher.wait(0.05))
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_wait_directory_change(self):
+        watcher = self._watcher([(self.watched, None)])
+        self._write_later(os.path.join(self.watched, 'new'))
+        start = time.monotonic()
+        self.assertTrue(watcher.wait(10))
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_wait_file_change(self):
+        watcher = self._watcher([(self.watched, 'data')])
+        self._write_later(os.path.join(self.watched, 'other'))
+        self.assertFalse(watcher.wait(0.2))
+        self._write_later(os.path.join(self.watched, 'data'))
+        self.assertTrue(watcher.wait(10))
+
+    def test_wait_directory_created(self):
+        missing = os.path.join(self.tmpdir, 'missing')
+        watcher = self._watcher([(missing, None)])
+        self.assertFalse(watcher.wait(0.01))
+        os.mkdir(missing)
+        self._write_later(os.path.join(missing, 'new'))
+        self.assertTrue(watcher.wait(10))
+
+    def test_watcher_unavailable(self):
+        self.useFixture(fixtures.MockPatchObject(
+            inotify.ctypes, 'CDLL', side_effect=OSError('no libc')))
+        self.assertIsNone(inotify.watcher([(self.watched, None)]))
+        self.assertIn('Unable to watch', self.log.output)
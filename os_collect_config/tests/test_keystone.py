@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
 import tempfile
+import threading
+import time
+from unittest import mock
 
 import fixtures
 from keystoneclient import exceptions as ks_exc
@@ -42,6 +46,15 @@ class FakeKeystoneDiscoverBase(test_heat.FakeKeystoneDiscover):
         return 'http://192.0.2.1:5000/'
 
 
+class FakeAuthRef:
+
+    def __init__(self, expires):
+        self.expires = expires
+
+    def will_expire_soon(self):
+        return False
+
+
 class KeystoneTest(testtools.TestCase):
     def setUp(self):
         super().setUp()
@@ -84,6 +97,166 @@ class KeystoneTest(testtools.TestCase):
             client(self, Configs),
             FakeKeystoneDiscoverBase)
 
+    def test_get_keystone(self):
+        client = test_heat.FakeKeystoneClient(self)
+        ks = keystone.get_keystone(
+            'http://192.0.2.1:5000/', 'auser', 'apassword', 'aproject',
+            client, test_heat.FakeKeystoneDiscover)
+        self.assertIs(ks, keystone.get_keystone(
+            'http://192.0.2.1:5000/', 'auser', 'apassword', 'aproject',
+            client, test_heat.FakeKeystoneDiscover))
+        self.assertIsNot(ks, keystone.get_keystone(
+            'http://192.0.2.1:5000/', 'auser', 'apassword', 'bproject',
+            client, test_heat.FakeKeystoneDiscover))
+
+    def test_discard_keystone(self):
+        client = test_heat.FakeKeystoneClient(self)
+        ks = keystone.get_keystone(
+            'http://192.0.2.1:5000/', 'auser', 'apassword', 'aproject',
+            client, test_heat.FakeKeystoneDiscover)
+        other = keystone.get_keystone(
+            'http://192.0.2.1:5000/', 'auser', 'apassword', 'bproject',
+            client, test_heat.FakeKeystoneDiscover)
+        keystone.discard_keystone(ks)
+        self.assertIsNot(ks, keystone.get_keystone(
+            'http://192.0.2.1:5000/', 'auser', 'apassword', 'aproject',
+            client, test_heat.FakeKeystoneDiscover))
+        self.assertIs(other, keystone.get_keystone(
+            'http://192.0.2.1:5000/', 'auser', 'apassword', 'bproject',
+            client, test_heat.FakeKeystoneDiscover))
+
+    def test_client_expiring(self):
+        ks = self._make_ks(test_heat.FakeKeystoneClient)
+        client = ks.client
+        client.auth_ref = mock.Mock(expires=None)
+        client.auth_ref.will_expire_soon.return_value = False
+        self.assertIs(client, ks.client)
+        client.auth_ref.will_expire_soon.return_value = True
+        with mock.patch.object(ks, 'invalidate_auth_ref') as invalidate:
+            ks.client
+            invalidate.assert_called_once_with()
+
+    def test_refresh_ahead(self):
+        self.useFixture(fixtures.MockPatchObject(
+            keystone, 'MIN_REFRESH_DELAY', 0.01))
+        cfg.CONF.set_override('refresh_margin', 60, group='keystone')
+        refreshed = threading.Event()
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        class FakeRefreshKeystoneClient(test_heat.FakeKeystoneClient):
+            clients = []
+
+            def Client(self, **kwargs):
+                if not self.clients:
+                    # Expires just after the refresh margin
+                    expires = now + datetime.timedelta(seconds=60.05)
+                else:
+                    expires = now + datetime.timedelta(hours=1)
+                    refreshed.set()
+                client = mock.Mock(auth_ref=FakeAuthRef(expires))
+                self.clients.append(client)
+                return client
+
+        ks = self._make_ks(FakeRefreshKeystoneClient)
+        first = ks.client
+        timer = ks._refresh_timer
+        timer.join(5)
+        self.assertTrue(refreshed.is_set())
+        self.addCleanup(ks.invalidate)
+        client = ks.client
+        self.assertIsNot(first, client)
+        self.assertEqual(
+            client.auth_ref.expires,
+            ks.cache.get(ks._make_key('auth_ref')).expires)
+        self.assertIsNot(timer, ks._refresh_timer)
+
+    def test_refresh_short_token(self):
+        # Tokens living no longer than the default margin of 300 seconds
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        class FakeShortKeystoneClient(test_heat.FakeKeystoneClient):
+            clients = []
+
+            def Client(self, **kwargs):
+                client = mock.Mock(auth_ref=FakeAuthRef(
+                    now + datetime.timedelta(seconds=120)))
+                self.clients.append(client)
+                return client
+
+        ks = self._make_ks(FakeShortKeystoneClient)
+        self.addCleanup(ks.invalidate)
+        client = ks.client
+        self.assertIsNone(ks._refresh_timer)
+        time.sleep(0.1)
+        self.assertIs(client, ks.client)
+        self.assertEqual(1, len(FakeShortKeystoneClient.clients))
+
+    def test_refresh_delay_floor(self):
+        # Tokens living just longer than the margin
+        self.useFixture(fixtures.MockPatchObject(
+            keystone, 'MIN_REFRESH_DELAY', 0.2))
+        cfg.CONF.set_override('refresh_margin', 60, group='keystone')
+
+        class FakeMarginKeystoneClient(test_heat.FakeKeystoneClient):
+            clients = []
+
+            def Client(self, **kwargs):
+                client = mock.Mock(auth_ref=FakeAuthRef(
+                    datetime.datetime.now(datetime.timezone.utc) +
+                    datetime.timedelta(seconds=60.01)))
+                self.clients.append(client)
+                return client
+
+        ks = self._make_ks(FakeMarginKeystoneClient)
+        self.addCleanup(ks.invalidate)
+        ks.client
+        time.sleep(0.5)
+        self.assertLessEqual(len(FakeMarginKeystoneClient.clients), 3)
+
+    def test_refresh_disabled(self):
+        cfg.CONF.set_override('refresh_margin', 0, group='keystone')
+        ks = self._make_ks(test_heat.FakeKeystoneClient)
+        client = ks.client
+        client.auth_ref = mock.Mock(expires=datetime.datetime.now(
+            datetime.timezone.utc))
+        ks._schedule_refresh()
+        self.assertIsNone(ks._refresh_timer)
+
+    def test_cache_auth_ref_memory_tier(self):
+        ks = self._make_ks(test_heat.FakeKeystoneClient)
+        auth_ref = ks.auth_ref
+        with mock.patch.object(ks.cache, 'get') as dbm_get:
+            self.assertEqual(auth_ref, ks.auth_ref)
+            self.assertEqual(auth_ref, ks._get_auth_ref_from_cache())
+            dbm_get.assert_not_called()
+        # Another wrapper on the same cache file shares the memory tier
+        ks2 = self._make_ks(test_heat.FakeFailKeystoneClient)
+        with mock.patch.object(ks2.cache, 'get') as dbm_get:
+            self.assertEqual(auth_ref, ks2.auth_ref)
+            dbm_get.assert_not_called()
+
+    def test_cache_auth_ref_dbm_tier(self):
+        ks = self._make_ks(test_heat.FakeKeystoneClient)
+        auth_ref = ks.auth_ref
+        # A fresh process only has the dbm tier
+        keystone._memory_caches.clear()
+        ks2 = self._make_ks(test_heat.FakeFailKeystoneClient)
+        self.assertEqual(auth_ref, ks2.auth_ref)
+        with mock.patch.object(ks2.cache, 'get') as dbm_get:
+            self.assertEqual(auth_ref, ks2.auth_ref)
+            dbm_get.assert_not_called()
+
+    def test_cache_auth_ref_expires_from_both_tiers(self):
+        ks = self._make_ks(test_heat.FakeKeystoneClient)
+        key = ks._make_key('auth_ref')
+        now = time.time()
+        with mock.patch('time.time', return_value=now - 1000):
+            ks.cache.set(key, 'an old auth_ref')
+        # Moves the ref from the dbm tier to the memory tier
+        self.assertEqual('an old auth_ref', ks._get_auth_ref_from_cache())
+        with mock.patch('time.time', return_value=now + 801):
+            self.assertFalse(ks._get_auth_ref_from_cache())
+
     def test_cache_auth_ref(self):
         ks = self._make_ks(test_heat.FakeKeystoneClient)
         auth_ref = ks.auth_ref
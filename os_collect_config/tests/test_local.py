@@ -13,10 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import json
 import locale
 import os
 import tempfile
+from unittest import mock
 
 import fixtures
 from oslo_config import cfg
@@ -109,20 +111,21 @@ class TestLocal(testtools.TestCase):
         self._setup_test_json(META_DATA, '00test.json')
         self._setup_test_json(META_DATA2, '99test.json')
 
-        # Monkey Patch os.listdir so it _always_ returns the wrong sort
-        unpatched_listdir = os.listdir
+        # Monkey Patch os.scandir so it _always_ returns the wrong sort
+        unpatched_scandir = os.scandir
 
-        def wrong_sort_listdir(path):
-            ret = unpatched_listdir(path)
+        def wrong_sort_scandir(path):
+            with unpatched_scandir(path) as entries:
+                ret = list(entries)
             save_locale = locale.getlocale()
             try:
                 locale.setlocale(locale.LC_ALL, 'C')
-                bad_sort = sorted(ret, reverse=True)
+                bad_sort = sorted(ret, key=lambda e: e.name, reverse=True)
             finally:
                 locale.setlocale(locale.LC_ALL, save_locale)
-            return bad_sort
+            return contextlib.nullcontext(bad_sort)
 
-        self.useFixture(fixtures.MonkeyPatch('os.listdir', wrong_sort_listdir))
+        self.useFixture(fixtures.MonkeyPatch('os.scandir', wrong_sort_scandir))
         local_md = self._call_collect()
 
         self.assertThat(local_md, matchers.IsInstance(list))
@@ -144,6 +147,35 @@ class TestLocal(testtools.TestCase):
         self.assertRaises(exc.LocalMetadataNotAvailable, self._call_collect)
         self.assertIn('is not valid JSON', self.log.output)
 
+    def test_collect_local_reuses_parsed(self):
+        md_name = self._setup_test_json(META_DATA)
+        self._setup_test_json(META_DATA2, 'other.json')
+        collector = local.Collector()
+        with mock.patch.object(local.json, 'loads',
+                               wraps=json.loads) as loads:
+            first = collector.collect()
+            self.assertEqual(first, collector.collect())
+            self.assertEqual(2, loads.call_count)
+
+            # Only the modified file is parsed again
+            with open(md_name, 'w') as md:
+                md.write(json.dumps(META_DATA2))
+            st = os.stat(md_name)
+            os.utime(md_name, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+            self.assertEqual(
+                [('other.json', META_DATA2), ('test.json', META_DATA2)],
+                collector.collect())
+            self.assertEqual(3, loads.call_count)
+
+        # Security checks still apply to unmodified files
+        os.chmod(md_name, 0o666)
+        self.assertRaises(exc.LocalMetadataNotAvailable, collector.collect)
+
+        os.unlink(md_name)
+        self.assertEqual([('other.json', META_DATA2)], collector.collect())
+        self.assertEqual([os.path.join(self.tdir, 'other.json')],
+                         list(collector._parsed))
+
     def test_collect_local_path_nonexist(self):
         cfg.CONF.set_override(name='path',
                               override=['/this/doesnt/exist'],
@@ -0,0 +1,113 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+import fixtures
+from oslo_config import cfg
+import testtools
+
+from os_collect_config import collect
+from os_collect_config import metrics
+
+
+class TestMetrics(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.log = self.useFixture(fixtures.FakeLogger())
+        collect.setup_conf()
+        self.addCleanup(cfg.CONF.reset)
+        self.cache_dir = self.useFixture(fixtures.TempDir())
+        # Other tests leave cachedir set as an attribute of CONF, which
+        # hides any override
+        self.useFixture(fixtures.MonkeyPatch(
+            'oslo_config.cfg.CONF.cachedir', self.cache_dir.path))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_collect_config.metrics._cycle', None))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_collect_config.metrics._cycles', 0))
+
+    def _store(self, name, content):
+        path = os.path.join(self.cache_dir.path, '%s.json' % name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_no_cycle(self):
+        with metrics.phase('collect'):
+            pass
+        metrics.collected('ec2', 1)
+        metrics.stored('ec2', self._store('ec2', '{}'), True)
+        self.assertIsNone(metrics.finish_cycle())
+        self.assertEqual(['ec2.json'], os.listdir(self.cache_dir.path))
+
+    def test_cycle(self):
+        cycle = metrics.start_cycle()
+        with metrics.phase('store'):
+            metrics.stored('ec2', self._store('ec2', '{"a": 1}'), True)
+            metrics.stored('ec2', self._store('ec2-2', '{}'), False)
+        with metrics.phase('store'):
+            pass
+        metrics.collected('ec2', 0.5)
+        self.assertIs(cycle, metrics.finish_cycle())
+        self.assertEqual(['store'], list(cycle.phases))
+        self.assertEqual({'ec2': {'seconds': 0.5, 'bytes': 10, 'keys': 2,
+                                  'keys_changed': 1}},
+                         cycle.collectors)
+        self.assertEqual(2, cycle.keys)
+        self.assertEqual(1, cycle.keys_changed)
+        self.assertEqual(1, cycle.cache_hits)
+        self.assertEqual(2, metrics.start_cycle().number)
+
+    def test_write_stats(self):
+        cfg.CONF.set_override('write_stats', True)
+        metrics.start_cycle()
+        metrics.stored('local', self._store('local', '{}'), True)
+        metrics.finish_cycle()
+        with open(os.path.join(self.cache_dir.path,
+                               'os_collect_config_stats.json')) as f:
+            stats = json.load(f)
+        self.assertEqual(1, stats['cycle'])
+        self.assertEqual(1, stats['keys_changed'])
+        self.assertEqual(2, stats['collectors']['local']['bytes'])
+
+    def test_prometheus_textfile(self):
+        textfile = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                'occ.prom')
+        cfg.CONF.set_override('prometheus_textfile', textfile)
+        metrics.start_cycle()
+        with metrics.phase('command'):
+            pass
+        metrics.collected('heat"local', 0.25)
+        metrics.finish_cycle()
+        with open(textfile) as f:
+            lines = f.read().splitlines()
+        self.assertIn('# TYPE os_collect_config_cycles_total counter', lines)
+        self.assertIn('os_collect_config_cycles_total 1', lines)
+        self.assertIn(
+            'os_collect_config_collector_seconds{collector="heat\\"local"} '
+            '0.25', lines)
+        self.assertTrue([line for line in lines if line.startswith(
+            'os_collect_config_phase_seconds{phase="command"} ')])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.cache_dir.path, 'os_collect_config_stats.json')))
+
+    def test_write_failure(self):
+        cfg.CONF.set_override('prometheus_textfile',
+                              '/nonexistent/dir/occ.prom')
+        metrics.start_cycle()
+        metrics.finish_cycle()
+        self.assertIn('Unable to write metrics', self.log.output)
@@ -15,6 +15,7 @@
 
 import calendar
 import json
+import os
 import time
 
 import fixtures
@@ -23,6 +24,7 @@ import requests
 import testtools
 from testtools import matchers
 
+from os_collect_config import cache
 from os_collect_config import collect
 from os_collect_config import exc
 from os_collect_config import request
@@ -99,9 +101,10 @@ SOFTWARE_CONFIG_DATA = {
 
 
 class FakeResponse(dict):
-    def __init__(self, text, headers=None):
+    def __init__(self, text, headers=None, status_code=200):
         self.text = text
         self.headers = headers
+        self.status_code = status_code
 
     def raise_for_status(self):
         pass
@@ -111,34 +114,44 @@ class FakeRequests:
     exceptions = requests.exceptions
 
     class Session:
-        def get(self, url, timeout=None):
-            return FakeResponse(json.dumps(META_DATA))
-
-        def head(self, url, timeout=None):
-            return FakeResponse('', headers={
+        def get(self, url, headers=None, timeout=None):
+            return FakeResponse(json.dumps(META_DATA), headers={
                 'last-modified': time.strftime(
                     "%a, %d %b %Y %H:%M:%S %Z", time.gmtime())})
 
 
-class FakeFailRequests:
+class FakeRequestsConditional:
     exceptions = requests.exceptions
 
     class Session:
-        def get(self, url, timeout=None):
-            raise requests.exceptions.HTTPError(403, 'Forbidden')
+        etag = '"c0ffee"'
+        last_modified = 'Fri, 02 Jan 2015 03:04:05 GMT'
+
+        def __init__(self):
+            self.requests = []
+
+        def get(self, url, headers=None, timeout=None):
+            self.requests.append(headers)
+            if headers and headers.get('If-None-Match') == self.etag:
+                return FakeResponse('', status_code=304)
+            return FakeResponse(json.dumps(META_DATA), headers={
+                'etag': self.etag,
+                'last-modified': self.last_modified})
+
+
+class FakeFailRequests:
+    exceptions = requests.exceptions
 
-        def head(self, url, timeout=None):
+    class Session:
+        def get(self, url, headers=None, timeout=None):
             raise requests.exceptions.HTTPError(403, 'Forbidden')
 
 
 class FakeRequestsSoftwareConfig:
 
     class Session:
-        def get(self, url, timeout=None):
-            return FakeResponse(json.dumps(SOFTWARE_CONFIG_DATA))
-
-        def head(self, url, timeout=None):
-            return FakeResponse('', headers={
+        def get(self, url, headers=None, timeout=None):
+            return FakeResponse(json.dumps(SOFTWARE_CONFIG_DATA), headers={
                 'last-modified': time.strftime(
                     "%a, %d %b %Y %H:%M:%S %Z", time.gmtime())})
 
@@ -168,6 +181,47 @@ class TestRequest(TestRequestBase):
 
         self.assertEqual('', self.log.output)
 
+    def test_collect_request_not_modified(self):
+        req_collect = request.Collector(requests_impl=FakeRequestsConditional)
+        req_md = req_collect.collect()
+        self.assertEqual({}, req_collect._session.requests[0])
+
+        # A 304 reuses the previous result
+        self.assertEqual(req_md, req_collect.collect())
+        self.assertEqual(
+            {'If-None-Match': '"c0ffee"',
+             'If-Modified-Since': 'Fri, 02 Jan 2015 03:04:05 GMT'},
+            req_collect._session.requests[1])
+
+    def test_collect_request_not_modified_last_modified(self):
+        # Servers which ignore conditional requests still send Last-Modified
+        req_collect = request.Collector(requests_impl=FakeRequestsConditional)
+        req_md = req_collect.collect()
+        req_collect.validators = {}
+        self.assertEqual(req_md, req_collect.collect())
+        self.assertEqual({}, req_collect._session.requests[1])
+
+    def test_collect_request_validators_persisted(self):
+        cache_dir = self.useFixture(fixtures.TempDir())
+        self.useFixture(fixtures.MonkeyPatch(
+            'oslo_config.cfg.CONF.cachedir', cache_dir.path))
+        req_collect = request.Collector(requests_impl=FakeRequestsConditional)
+        req_md = req_collect.collect()
+        self.assertTrue(os.path.exists(
+            os.path.join(cache_dir.path, 'request.json.validators')))
+        cache.store('request', req_md[0][1])
+
+        # A new process sends the saved validators
+        req_collect = request.Collector(requests_impl=FakeRequestsConditional)
+        self.assertEqual(req_md, req_collect.collect())
+        self.assertIn('If-None-Match', req_collect._session.requests[0])
+
+        # But not when the cached copy does not match them
+        cache.store('request', {'other': 'value'})
+        req_collect = request.Collector(requests_impl=FakeRequestsConditional)
+        self.assertEqual(req_md, req_collect.collect())
+        self.assertEqual({}, req_collect._session.requests[0])
+
     def test_collect_request_fail(self):
         req_collect = request.Collector(requests_impl=FakeFailRequests)
         self.assertRaises(exc.RequestMetadataNotAvailable, req_collect.collect)
@@ -0,0 +1,108 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import select
+from unittest import mock
+
+import fixtures
+from oslo_config import cfg
+import testtools
+
+from os_collect_config import collect
+from os_collect_config import schedule
+
+
+class TestScheduler(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        collect.setup_conf()
+        self.addCleanup(cfg.CONF.reset)
+        cfg.CONF.set_override('min_polling_interval', 1)
+        cfg.CONF.set_override('polling_interval', 8)
+
+    def _run(self, scheduler, cycles):
+        sleeps = []
+        polls = []
+        for i in range(cycles):
+            due = scheduler.due()
+            polls.append(due)
+            scheduler.polled(due)
+            sleep_time = scheduler.next_sleep()
+            sleeps.append(sleep_time)
+            scheduler.slept(sleep_time)
+        return (polls, sleeps)
+
+    def test_global_schedule(self):
+        scheduler = schedule.Scheduler(['ec2', 'local'])
+        (polls, sleeps) = self._run(scheduler, 6)
+        self.assertEqual([1, 2, 4, 8, 8, 8], sleeps)
+        self.assertEqual([['ec2', 'local']] * 6, polls)
+
+    def test_per_collector_schedule(self):
+        cfg.CONF.set_override('min_polling_interval', 4, group='ec2')
+        cfg.CONF.set_override('polling_interval', 4, group='ec2')
+        cfg.CONF.set_override('polling_interval', 2, group='local')
+        scheduler = schedule.Scheduler(['ec2', 'local'])
+        (polls, sleeps) = self._run(scheduler, 5)
+        self.assertEqual([1, 2, 1, 1, 2], sleeps)
+        self.assertEqual([['ec2', 'local'], ['local'], ['local'],
+                          ['ec2'], ['local']], polls)
+
+    def test_wake(self):
+        scheduler = schedule.Scheduler(['ec2', 'local'])
+        scheduler.polled(scheduler.due())
+        scheduler.slept(0.5)
+        self.assertEqual([], scheduler.due())
+        scheduler.wake(['local'])
+        self.assertEqual(['local'], scheduler.due())
+        self.assertEqual(0, scheduler.next_sleep())
+
+    @mock.patch('random.uniform')
+    def test_jitter(self, uniform):
+        uniform.return_value = 0.25
+        cfg.CONF.set_override('polling_jitter', 0.5, group='ec2')
+        scheduler = schedule.Scheduler(['ec2'])
+        scheduler.polled(scheduler.due())
+        self.assertEqual(1.25, scheduler.next_sleep())
+        uniform.assert_called_once_with(0, 0.5)
+
+
+class TestNotify(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        schedule.notified()
+        self.addCleanup(schedule.notified)
+
+    def test_listening(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_collect_config.schedule._notify_pipe', None))
+        self.assertFalse(schedule.listening())
+        fd = schedule.notify_fd()
+        self.addCleanup(os.close, fd)
+        self.addCleanup(os.close, schedule._notify_pipe[1])
+        self.assertTrue(schedule.listening())
+
+    def test_notify(self):
+        fd = schedule.notify_fd()
+        self.assertEqual([], select.select([fd], [], [], 0)[0])
+        schedule.notify('zaqar')
+        schedule.notify('local')
+        schedule.notify('zaqar')
+        self.assertEqual([fd], select.select([fd], [], [], 0)[0])
+        self.assertEqual(['local', 'zaqar'], schedule.notified())
+        self.assertEqual([], select.select([fd], [], [], 0)[0])
+        self.assertEqual([], schedule.notified())
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 import json
+import queue
+import threading
 from unittest import mock
 
 import fixtures
@@ -27,6 +29,7 @@ from zaqarclient.transport import response
 
 from os_collect_config import collect
 from os_collect_config import exc
+from os_collect_config import schedule
 from os_collect_config.tests import test_heat
 from os_collect_config import zaqar
 
@@ -39,6 +42,22 @@ class FakeKeystoneClient(test_heat.FakeKeystoneClient):
         return 'http://192.0.2.1:8888/'
 
 
+class FakeCountingKeystoneClient(FakeKeystoneClient):
+
+    def __init__(self, testcase, configs=None):
+        super().__init__(testcase, configs)
+        self.clients = 0
+        self.url_fors = 0
+
+    def Client(self, **kwargs):
+        self.clients += 1
+        return super().Client(**kwargs)
+
+    def url_for(self, **kwargs):
+        self.url_fors += 1
+        return super().url_for(**kwargs)
+
+
 class FakeKeystoneClientWebsocket(test_heat.FakeKeystoneClient):
 
     def url_for(self, service_type, endpoint_type):
@@ -88,13 +107,66 @@ class FakeZaqarWebsocketClient:
         pass
 
 
+class FakePersistentWebsocketClient(FakeZaqarWebsocketClient):
+
+    def __init__(self, options, messages=None, testcase=None):
+        super().__init__(options, messages, testcase)
+        self.actions = []
+        self.bodies = []
+        self.pushed = queue.Queue()
+
+    def send(self, request):
+        self.actions.append(request.operation)
+        self.bodies.append(json.loads(request.content))
+        return super().send(request)
+
+    def recv(self):
+        body = self.pushed.get(timeout=5)
+        if body is None:
+            raise ConnectionError('Connection closed')
+        return {'body': body}
+
+    def cleanup(self):
+        self.pushed.put(None)
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+
 class FakeQueue:
 
-    def pop(self):
+    def pop(self, count=1):
         return iter([message.Message(
             queue=self, ttl=10, age=10, body=test_heat.META_DATA, href='')])
 
 
+class FakeBacklogZaqarClient(FakeZaqarClient):
+
+    def __init__(self, testcase):
+        super().__init__(testcase)
+        self.fake_queue = FakeBacklogQueue()
+
+    def queue(self, queue_id):
+        return self.fake_queue
+
+
+class FakeBacklogQueue:
+
+    def __init__(self):
+        self.backlog = [
+            {'old': 'value'},
+            test_heat.SOFTWARE_CONFIG_DATA,
+            test_heat.META_DATA,
+        ]
+
+    def pop(self, count=1):
+        popped = self.backlog[:count]
+        self.backlog = self.backlog[count:]
+        return iter([message.Message(
+            queue=self, ttl=10, age=10, body=body, href='')
+            for body in popped])
+
+
 class FakeZaqarClientSoftwareConfig:
 
     def __init__(self, testcase):
@@ -113,7 +185,7 @@ class FakeZaqarClientSoftwareConfig:
 
 class FakeQueueSoftwareConfig:
 
-    def pop(self):
+    def pop(self, count=1):
         return iter([message.Message(
             queue=self, ttl=10, age=10, body=test_heat.SOFTWARE_CONFIG_DATA,
             href='')])
@@ -175,6 +247,48 @@ class TestZaqar(testtools.TestCase):
         self.assertEqual(
             ('dep-name1', {'config1': 'value1'}), zaqar_md[1])
 
+    def test_collect_zaqar_drain(self):
+        self.useFixture(config_fixture.Config()).config(
+            group='zaqar', max_messages=5)
+        zaqar_client = FakeBacklogZaqarClient(self)
+        zaqar_md = zaqar.Collector(
+            keystoneclient=FakeKeystoneClient(self, cfg.CONF.zaqar),
+            zaqarclient=zaqar_client,
+            discover_class=test_heat.FakeKeystoneDiscover).collect()
+        # The whole backlog is consumed and the newest message wins
+        self.assertEqual([('zaqar', test_heat.META_DATA)], zaqar_md)
+        self.assertEqual([], zaqar_client.fake_queue.backlog)
+
+    def test_max_messages_limit(self):
+        # Zaqar rejects pops of more than 20 messages by default
+        self.addCleanup(cfg.CONF.reset)
+        self.assertRaises(ValueError, cfg.CONF.set_override,
+                          'max_messages', 21, group='zaqar')
+        cfg.CONF.set_override('max_messages', 20, group='zaqar')
+
+    def test_collect_zaqar_empty(self):
+        zaqar_client = FakeBacklogZaqarClient(self)
+        zaqar_collect = zaqar.Collector(
+            keystoneclient=FakeKeystoneClient(self, cfg.CONF.zaqar),
+            zaqarclient=zaqar_client,
+            discover_class=test_heat.FakeKeystoneDiscover)
+        zaqar_collect.collect()
+        zaqar_client.fake_queue.backlog = []
+        self.assertRaises(
+            exc.ZaqarMetadataNotAvailable, zaqar_collect.collect)
+        self.assertIn('No messages in queue', self.log.output)
+
+    def test_collect_zaqar_reuses_keystone(self):
+        ks_client = FakeCountingKeystoneClient(self, cfg.CONF.zaqar)
+        zaqar_collect = zaqar.Collector(
+            keystoneclient=ks_client,
+            zaqarclient=FakeZaqarClient(self),
+            discover_class=test_heat.FakeKeystoneDiscover)
+        zaqar_md = zaqar_collect.collect()
+        self.assertEqual(zaqar_md, zaqar_collect.collect())
+        self.assertEqual(1, ks_client.clients)
+        self.assertEqual(1, ks_client.url_fors)
+
     @mock.patch.object(ks_discover.Discover, '__init__')
     @mock.patch.object(ks_discover.Discover, 'url_for')
     def test_collect_zaqar_fail(self, mock_url_for, mock___init__):
@@ -280,3 +394,152 @@ class TestZaqar(testtools.TestCase):
         for k in ('int1', 'strfoo', 'map_ab'):
             self.assertIn(k, zaqar_md)
             self.assertEqual(zaqar_md[k], test_heat.META_DATA[k])
+
+    @mock.patch.object(transport, 'get_transport_for')
+    @mock.patch.object(ks_discover.Discover, '__init__')
+    @mock.patch.object(ks_discover.Discover, 'url_for')
+    def test_collect_zaqar_websocket_drain(self, mock_url_for, mock___init__,
+                                           mock_transport):
+        mock___init__.return_value = None
+        mock_url_for.return_value = cfg.CONF.zaqar.auth_url
+        conf = config_fixture.Config()
+        self.useFixture(conf)
+        conf.config(group='zaqar', use_websockets=True)
+        conf.config(group='zaqar', max_messages=5)
+        messages = {'messages': [
+            {'body': test_heat.SOFTWARE_CONFIG_DATA, 'id': 1},
+            {'body': test_heat.META_DATA, 'id': 2}]}
+        ws = FakePersistentWebsocketClient(
+            {}, messages=messages, testcase=self)
+        mock_transport.return_value = ws
+        zaqar_md = zaqar.Collector(
+            keystoneclient=FakeKeystoneClientWebsocket(self, cfg.CONF.zaqar)
+        ).collect()
+        self.assertEqual([('zaqar', test_heat.META_DATA)], zaqar_md)
+        self.assertEqual('message_delete_many', ws.actions[2])
+        self.assertEqual(5, ws.bodies[2]['pop'])
+
+    def _persistent_collector(self, mock_url_for, mock___init__,
+                              mock_transport, connections):
+        mock___init__.return_value = None
+        mock_url_for.return_value = cfg.CONF.zaqar.auth_url
+        mock_transport.side_effect = connections
+        conf = config_fixture.Config()
+        self.useFixture(conf)
+        conf.config(group='zaqar', use_websockets=True)
+        conf.config(group='zaqar', persistent_websocket=True)
+        conf.config(group='zaqar', reconnect_max_delay=0)
+        self.notified = threading.Event()
+        self.useFixture(fixtures.MockPatchObject(
+            schedule, 'notify', side_effect=lambda c: self.notified.set()))
+        self.useFixture(fixtures.MockPatchObject(
+            schedule, 'listening', return_value=True))
+        zaqar_collect = zaqar.Collector(
+            keystoneclient=FakeKeystoneClientWebsocket(self, cfg.CONF.zaqar))
+        self.addCleanup(zaqar_collect.close)
+        return zaqar_collect
+
+    @mock.patch.object(transport, 'get_transport_for')
+    @mock.patch.object(ks_discover.Discover, '__init__')
+    @mock.patch.object(ks_discover.Discover, 'url_for')
+    def test_collect_zaqar_persistent_websocket(self, mock_url_for,
+                                                mock___init__,
+                                                mock_transport):
+        ws = FakePersistentWebsocketClient({}, messages={}, testcase=self)
+        zaqar_collect = self._persistent_collector(
+            mock_url_for, mock___init__, mock_transport, [ws])
+        self.assertTrue(zaqar.pushes())
+        # Nothing has been pushed yet
+        self.assertRaises(
+            exc.ZaqarMetadataNotAvailable, zaqar_collect.collect)
+
+        ws.pushed.put(test_heat.META_DATA)
+        self.assertTrue(self.notified.wait(5))
+        zaqar_md = zaqar_collect.collect()
+        self.assertEqual([('zaqar', test_heat.META_DATA)], zaqar_md)
+        # Collecting again returns the last message without blocking
+        self.assertEqual(zaqar_md, zaqar_collect.collect())
+
+        self.notified.clear()
+        ws.pushed.put(test_heat.SOFTWARE_CONFIG_DATA)
+        self.assertTrue(self.notified.wait(5))
+        zaqar_md = zaqar_collect.collect()
+        self.assertEqual(('dep-name1', {'config1': 'value1'}), zaqar_md[1])
+
+        # The connection and subscription are only set up once
+        self.assertEqual(1, mock_transport.call_count)
+        self.assertEqual(
+            ['queue_create', 'subscription_create', 'message_delete_many'],
+            ws.actions)
+
+    @mock.patch.object(transport, 'get_transport_for')
+    @mock.patch.object(ks_discover.Discover, '__init__')
+    @mock.patch.object(ks_discover.Discover, 'url_for')
+    def test_collect_zaqar_persistent_websocket_backlog(self, mock_url_for,
+                                                        mock___init__,
+                                                        mock_transport):
+        messages = {'messages': [{'body': test_heat.META_DATA, 'id': 1}]}
+        ws = FakePersistentWebsocketClient(
+            {}, messages=messages, testcase=self)
+        zaqar_collect = self._persistent_collector(
+            mock_url_for, mock___init__, mock_transport, [ws])
+        # The first collect returns the message queued before subscribing
+        self.assertEqual([('zaqar', test_heat.META_DATA)],
+                         zaqar_collect.collect())
+
+    @mock.patch.object(transport, 'get_transport_for')
+    @mock.patch.object(ks_discover.Discover, '__init__')
+    @mock.patch.object(ks_discover.Discover, 'url_for')
+    def test_collect_zaqar_persistent_websocket_one_time(self, mock_url_for,
+                                                         mock___init__,
+                                                         mock_transport):
+        ws = FakePersistentWebsocketClient({}, messages={}, testcase=self)
+        ws.pushed.put(test_heat.META_DATA)
+        zaqar_collect = self._persistent_collector(
+            mock_url_for, mock___init__, mock_transport, [ws])
+        # Without a main loop waiting for pushes, as with --one-time, the
+        # websocket is used once and blocks for the data
+        schedule.listening.return_value = False
+        self.assertEqual([('zaqar', test_heat.META_DATA)],
+                         zaqar_collect.collect())
+        self.assertIsNone(zaqar_collect._listener)
+
+    def test_close_without_lock(self):
+        # close() runs from the SIGHUP handler, which can interrupt the
+        # thread holding the lock
+        zaqar_collect = zaqar.Collector(
+            keystoneclient=FakeKeystoneClientWebsocket(self, cfg.CONF.zaqar))
+        ws = mock.Mock()
+        zaqar_collect._ws = ws
+        with zaqar_collect._ws_lock:
+            closer = threading.Thread(target=zaqar_collect.close,
+                                      daemon=True)
+            closer.start()
+            closer.join(5)
+            self.assertFalse(closer.is_alive())
+        ws.cleanup.assert_called_once_with()
+        self.assertTrue(zaqar_collect._stopped.is_set())
+
+    @mock.patch.object(transport, 'get_transport_for')
+    @mock.patch.object(ks_discover.Discover, '__init__')
+    @mock.patch.object(ks_discover.Discover, 'url_for')
+    def test_collect_zaqar_persistent_websocket_reconnect(self, mock_url_for,
+                                                          mock___init__,
+                                                          mock_transport):
+        ws1 = FakePersistentWebsocketClient({}, messages={}, testcase=self)
+        ws1.pushed.put(None)
+        messages = {'messages': [{'body': test_heat.META_DATA, 'id': 1}]}
+        ws2 = FakePersistentWebsocketClient(
+            {}, messages=messages, testcase=self)
+        zaqar_collect = self._persistent_collector(
+            mock_url_for, mock___init__, mock_transport, [ws1, ws2])
+        try:
+            # Starts listening, the message may not have arrived yet
+            zaqar_collect.collect()
+        except exc.ZaqarMetadataNotAvailable:
+            pass
+        self.assertTrue(self.notified.wait(5))
+        self.assertEqual([('zaqar', test_heat.META_DATA)],
+                         zaqar_collect.collect())
+        self.assertEqual(2, mock_transport.call_count)
+        self.assertIn('Connection closed', self.log.output)
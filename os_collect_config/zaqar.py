@@ -13,17 +13,16 @@
 # limitations under the License.
 
 import json
+import threading
+import time
 
-from keystoneclient.v3 import client as keystoneclient
 from oslo_config import cfg
 from oslo_log import log
-from zaqarclient.queues.v2 import client as zaqarclient
-from zaqarclient import transport
-from zaqarclient.transport import request
 
 from os_collect_config import exc
 from os_collect_config import keystone
 from os_collect_config import merger
+from os_collect_config import schedule
 
 CONF = cfg.CONF
 logger = log.getLogger(__name__)
@@ -43,6 +42,25 @@ opts = [
     cfg.BoolOpt('use-websockets',
                 default=False,
                 help='Use the websocket transport to connect to Zaqar.'),
+    cfg.IntOpt('max-messages',
+               default=1,
+               min=1,
+               max=20,
+               help='Maximum number of queued messages to consume per poll. '
+                    'Each message holds the complete metadata, so only the '
+                    'newest is used and the older ones are discarded. Must '
+                    'not exceed the max_messages_per_claim_or_pop setting '
+                    'of the Zaqar server, which defaults to 20.'),
+    cfg.BoolOpt('persistent-websocket',
+                default=False,
+                help='Keep the websocket connection and queue subscription '
+                     'open between polls, and collect as soon as a message '
+                     'is pushed. Only used with use-websockets.'),
+    cfg.FloatOpt('reconnect-max-delay',
+                 default=60,
+                 min=0,
+                 help='Maximum seconds to wait before reconnecting a '
+                      'persistent websocket after a failure.'),
     cfg.StrOpt('region-name',
                help='Region Name for extracting Zaqar endpoint'),
     cfg.BoolOpt('ssl-certificate-validation',
@@ -53,68 +71,116 @@ opts = [
 ]
 name = 'zaqar'
 
+SUBSCRIPTION_TTL = 10000
+
+# Seconds the first collect with a persistent websocket waits for the
+# messages queued before it subscribed.
+BACKLOG_TIMEOUT = 10
+
+
+def pushes():
+    return CONF.zaqar.use_websockets and CONF.zaqar.persistent_websocket
+
 
 class Collector:
     def __init__(self,
-                 keystoneclient=keystoneclient,
-                 zaqarclient=zaqarclient,
+                 keystoneclient=None,
+                 zaqarclient=None,
                  discover_class=None,
-                 transport=transport):
+                 transport=None):
+        # The client libraries are only imported once zaqar is collected from
+        if keystoneclient is None:
+            from keystoneclient.v3 import client as keystoneclient
+        if zaqarclient is None:
+            from zaqarclient.queues.v2 import client as zaqarclient
+        if transport is None:
+            from zaqarclient import transport
         self.keystoneclient = keystoneclient
         self.zaqarclient = zaqarclient
         self.discover_class = discover_class
         self.transport = transport
+        self._endpoints = {}
+        self._listener = None
+        self._ws = None
+        self._ws_conf = None
+        self._ws_connected = 0
+        self._ws_lock = threading.Lock()
+        self._ws_data = None
+        self._ws_renew = False
+        self._ws_ready = threading.Event()
+        self._stopped = threading.Event()
+
+    def _endpoint_for(self, ks, service_type):
+        if service_type not in self._endpoints:
+            kwargs = {'service_type': service_type,
+                      'endpoint_type': 'publicURL'}
+            if CONF.zaqar.region_name:
+                kwargs['region_name'] = CONF.zaqar.region_name
+            self._endpoints[service_type] = ks.service_catalog.url_for(
+                **kwargs)
+        return self._endpoints[service_type]
 
     def get_data_wsgi(self, ks, conf):
-        kwargs = {'service_type': 'messaging', 'endpoint_type': 'publicURL'}
-        if CONF.zaqar.region_name:
-            kwargs['region_name'] = CONF.zaqar.region_name
-        endpoint = ks.service_catalog.url_for(**kwargs)
+        endpoint = self._endpoint_for(ks, 'messaging')
         logger.debug('Fetching metadata from %s' % endpoint)
         zaqar = self.zaqarclient.Client(endpoint, conf=conf, version=2)
 
         queue = zaqar.queue(CONF.zaqar.queue_id)
-        r = next(queue.pop())
-        return r.body
+        messages = list(queue.pop(count=CONF.zaqar.max_messages))
+        if not messages:
+            raise exc.ZaqarMetadataNotAvailable(
+                'No messages in queue %s' % CONF.zaqar.queue_id)
+        return self._newest(messages).body
+
+    def _newest(self, messages):
+        # Messages are popped oldest first
+        if len(messages) > 1:
+            logger.debug('Discarding %d superseded messages' %
+                         (len(messages) - 1))
+        return messages[-1]
 
     def _create_req(self, endpoint, action, body):
+        from zaqarclient.transport import request
         return request.Request(endpoint, action, content=json.dumps(body))
 
+    def _subscribe(self, ws, endpoint):
+        # create queue
+        req = self._create_req(endpoint, 'queue_create',
+                               {'queue_name': CONF.zaqar.queue_id})
+        ws.send(req)
+        # subscribe to queue messages
+        req = self._create_req(endpoint, 'subscription_create',
+                               {'queue_name': CONF.zaqar.queue_id,
+                                'ttl': SUBSCRIPTION_TTL})
+        ws.send(req)
+
+    def _pop(self, ws, endpoint):
+        # check for pre-existing messages
+        req = self._create_req(endpoint, 'message_delete_many',
+                               {'queue_name': CONF.zaqar.queue_id,
+                                'pop': CONF.zaqar.max_messages})
+        resp = ws.send(req)
+        messages = json.loads(resp.content).get('messages', [])
+        if len(messages) > 0:
+            # NOTE(dprince) In this case we are checking for queue
+            # messages that arrived before we subscribed.
+            logger.debug('Websocket message found...')
+            return self._newest(messages)['body']
+
     def get_data_websocket(self, ks, conf):
-        kwargs = {'service_type': 'messaging-websocket',
-                  'endpoint_type': 'publicURL'}
-        if CONF.zaqar.region_name:
-            kwargs['region_name'] = CONF.zaqar.region_name
-        endpoint = ks.service_catalog.url_for(**kwargs)
+        endpoint = self._endpoint_for(ks, 'messaging-websocket')
+
+        # Only keep the connection when the main loop waits for pushes,
+        # one-shot runs need the data from this call.
+        if CONF.zaqar.persistent_websocket and schedule.listening():
+            return self._get_data_persistent(endpoint, conf)
 
         logger.debug('Fetching metadata from %s' % endpoint)
 
         with self.transport.get_transport_for(endpoint, options=conf) as ws:
-            # create queue
-            req = self._create_req(endpoint, 'queue_create',
-                                   {'queue_name': CONF.zaqar.queue_id})
-            ws.send(req)
-            # subscribe to queue messages
-            req = self._create_req(endpoint, 'subscription_create',
-                                   {'queue_name': CONF.zaqar.queue_id,
-                                    'ttl': 10000})
-            ws.send(req)
-
-            # check for pre-existing messages
-            req = self._create_req(endpoint, 'message_delete_many',
-                                   {'queue_name': CONF.zaqar.queue_id,
-                                    'pop': 1})
-            resp = ws.send(req)
-            messages = json.loads(resp.content).get('messages', [])
-
-            if len(messages) > 0:
-                # NOTE(dprince) In this case we are checking for queue
-                # messages that arrived before we subscribed.
-                logger.debug('Websocket message found...')
-                msg_0 = messages[0]
-                data = msg_0['body']
-
-            else:
+            self._subscribe(ws, endpoint)
+            data = self._pop(ws, endpoint)
+            if data is None:
                 # NOTE(dprince) This will block until there is data available
                 # or the socket times out. Because we subscribe to the queue
                 # it will allow us to process data immediately.
@@ -123,6 +189,81 @@ class Collector:
 
         return data
 
+    def _get_data_persistent(self, endpoint, conf):
+        # Reconnects use the most recent token
+        self._ws_conf = conf
+        if self._listener is None or not self._listener.is_alive():
+            self._listener = threading.Thread(
+                target=self._listen, args=(endpoint,), daemon=True)
+            self._listener.start()
+        # Include the backlog popped by the listener in the first result
+        self._ws_ready.wait(BACKLOG_TIMEOUT)
+        with self._ws_lock:
+            if (self._ws is not None and time.monotonic() -
+                    self._ws_connected > SUBSCRIPTION_TTL / 2):
+                # Reconnect to renew the subscription before it expires
+                logger.debug('Renewing websocket subscription')
+                self._ws_renew = True
+                self._ws.cleanup()
+            data = self._ws_data
+        if data is None:
+            raise exc.ZaqarMetadataNotAvailable(
+                'No message received from %s yet' % endpoint)
+        return data
+
+    def _received(self, data):
+        with self._ws_lock:
+            self._ws_data = data
+        schedule.notify(name)
+
+    def _listen(self, endpoint):
+        '''Receive pushed messages until the process exits.'''
+        delay = 0
+        while not self._stopped.is_set():
+            try:
+                logger.debug('Connecting websocket to %s' % endpoint)
+                ws = self.transport.get_transport_for(
+                    endpoint, options=self._ws_conf)
+                with ws:
+                    self._subscribe(ws, endpoint)
+                    with self._ws_lock:
+                        if self._stopped.is_set():
+                            return
+                        self._ws = ws
+                        self._ws_connected = time.monotonic()
+                    data = self._pop(ws, endpoint)
+                    if data is not None:
+                        self._received(data)
+                    self._ws_ready.set()
+                    delay = 0
+                    while True:
+                        self._received(ws.recv()['body'])
+            except Exception as e:
+                self._ws_ready.set()
+                with self._ws_lock:
+                    self._ws = None
+                    renew = self._ws_renew
+                    self._ws_renew = False
+                if renew or self._stopped.is_set():
+                    continue
+                delay = min(max(delay * 2, 1),
+                            CONF.zaqar.reconnect_max_delay)
+                logger.warning('Websocket connection to %s lost (%s), '
+                               'reconnecting in %.1f seconds' %
+                               (endpoint, e, delay))
+                self._stopped.wait(delay)
+
+    def close(self):
+        '''Stop receiving pushed messages.
+
+        Called from the SIGHUP handler, which may interrupt a thread
+        holding _ws_lock, so the lock is not taken here.
+        '''
+        self._stopped.set()
+        ws = self._ws
+        if ws is not None:
+            ws.cleanup()
+
     def collect(self):
         if CONF.zaqar.auth_url is None:
             logger.warning('No auth_url configured.')
@@ -147,14 +288,16 @@ class Collector:
         # NOTE(flwang): To be compatible with old versions, we won't throw
         # error here if there is no region name.
 
+        keystone_wrapper = None
         try:
-            ks = keystone.Keystone(
+            keystone_wrapper = keystone.get_keystone(
                 auth_url=CONF.zaqar.auth_url,
                 user_id=CONF.zaqar.user_id,
                 password=CONF.zaqar.password,
                 project_id=CONF.zaqar.project_id,
                 keystoneclient=self.keystoneclient,
-                discover_class=self.discover_class).client
+                discover_class=self.discover_class)
+            ks = keystone_wrapper.client
 
             conf = {
                 'auth_opts': {
@@ -179,4 +322,10 @@ class Collector:
 
         except Exception as e:
             logger.warning(str(e))
+            self._endpoints = {}
+            from zaqarclient.transport import errors as zaqar_errors
+            auth_errors = keystone.auth_errors() + (
+                zaqar_errors.UnauthorizedError,)
+            if keystone_wrapper and isinstance(e, auth_errors):
+                keystone.discard_keystone(keystone_wrapper)
             raise exc.ZaqarMetadataNotAvailable()
@@ -0,0 +1,70 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the start up time of os-collect-config.
+
+Every scenario is run in a fresh interpreter, as happens on each re-exec,
+and the best and median wall times are printed:
+
+    python tools/startup_benchmark.py [--runs N]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MAIN = ('import sys; from os_collect_config import collect; '
+        'sys.exit(collect.main(sys.argv))')
+
+
+def run(args):
+    cmd = [sys.executable, '-c', MAIN] + args
+    start = time.monotonic()
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Number of runs of each scenario')
+    runs = parser.parse_args().runs
+
+    with tempfile.TemporaryDirectory() as tmp:
+        local_path = os.path.join(tmp, 'local-data')
+        os.mkdir(local_path)
+        with open(os.path.join(local_path, 'data.json'), 'w') as f:
+            json.dump({'key': 'value'}, f)
+        common = ['--config-file', '/dev/null',
+                  '--cachedir', os.path.join(tmp, 'cache'),
+                  '--backup-cachedir', os.path.join(tmp, 'backup')]
+        scenarios = [
+            ('--print-cachedir', ['--print-cachedir']),
+            ('local one-shot', ['local', '--local-path', local_path,
+                                '--one-time', '-c', 'true']),
+        ]
+        print('%-20s %10s %10s' % ('scenario', 'best', 'median'))
+        for name, args in scenarios:
+            times = [run(args + common) for i in range(runs)]
+            print('%-20s %9.1fms %9.1fms' % (
+                name, min(times) * 1000, statistics.median(times) * 1000))
+
+
+if __name__ == '__main__':
+    main()